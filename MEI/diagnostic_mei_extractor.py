@@ -7,6 +7,7 @@ and the image matching process.
 
 import os
 import sys
+import traceback
 import argparse
 import xml.etree.ElementTree as ET
 from PIL import Image
@@ -190,7 +191,6 @@ def analyze_mei_structure(mei_file):
     
     except Exception as e:
         print(f"Error analyzing MEI file: {e}")
-        import traceback
         traceback.print_exc()
 
 def check_image_path(image_dir, mei_file):
@@ -268,7 +268,6 @@ def check_image_path(image_dir, mei_file):
     
     except Exception as e:
         print(f"Error checking image paths: {e}")
-        import traceback
         traceback.print_exc()
 
 def parse_mei_file(mei_file):
@@ -508,7 +507,6 @@ def parse_mei_file(mei_file):
     
     except Exception as e:
         print(f"Error parsing MEI file: {e}")
-        import traceback
         traceback.print_exc()
         return {}
 
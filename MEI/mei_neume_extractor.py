@@ -8,6 +8,7 @@ troubleshooting and processing hundreds of MEI files.
 
 import os
 import sys
+import traceback
 import argparse
 import xml.etree.ElementTree as ET
 from PIL import Image
@@ -616,7 +617,6 @@ def main():
                 
             except Exception as e:
                 print(f"Error during analysis: {e}")
-                import traceback
                 traceback.print_exc()
                 
         else:
@@ -9,12 +9,24 @@ import requests
 from PIL import Image
 from io import BytesIO
 
+# Region/size/rotation suffix of an annotation URL, e.g. /1425,1005,67,76/64,/0/default.jpg
+REGION_SUFFIX_PATTERN = re.compile(r'/[\d]+,[\d]+,[\d]+,[\d]+/64,/0/default.jpg')
+
+# Region coordinates, e.g. 1425,1005,67,76
+COORDS_PATTERN = re.compile(r'([\d]+),([\d]+),([\d]+),([\d]+)')
+
+# Characters not allowed in a neume type directory name, e.g. the space in "clivis flat"
+UNSAFE_NAME_PATTERN = re.compile(r'[^\w\-_]')
+
 class IIIFExtractor:
     def __init__(self, annotations_file='annotations.json', output_dir='extracted_neumes'):
         self.annotations_file = annotations_file
         self.output_dir = output_dir
         self.annotations = None
         self.metadata = []
+        # Added to every image index, so a caller extracting one type in
+        # several batches gets filenames that are unique across the type
+        self.index_offset = 0
     
     def load_annotations(self):
         """Load the annotations data from JSON file"""
@@ -34,10 +46,10 @@ class IIIFExtractor:
     def extract_image_info(self, url):
         """Extract IIIF image information from URL"""
         # Example URL: http://www.e-codices.unifr.ch/loris/csg/csg-0390/csg-0390_007.jp2/1425,1005,67,76/64,/0/default.jpg
-        base_url = re.sub(r'/[\d]+,[\d]+,[\d]+,[\d]+/64,/0/default.jpg', '', url)
+        base_url = REGION_SUFFIX_PATTERN.sub('', url)
         
         # Extract coordinates
-        coords_match = re.search(r'([\d]+),([\d]+),([\d]+),([\d]+)', url)
+        coords_match = COORDS_PATTERN.search(url)
         if not coords_match:
             raise ValueError(f"Could not extract coordinates from URL: {url}")
         
@@ -97,7 +109,7 @@ class IIIFExtractor:
             print(f"Processing {neume_type} ({len(annotation['urls'])} images)")
             
             # Create directory for this neume type
-            neume_dir = os.path.join(self.output_dir, re.sub(r'[^\w\-_]', '_', neume_type))
+            neume_dir = os.path.join(self.output_dir, UNSAFE_NAME_PATTERN.sub('_', neume_type))
             os.makedirs(neume_dir, exist_ok=True)
             
             for i, url in enumerate(annotation['urls']):
@@ -111,7 +123,7 @@ class IIIFExtractor:
                     img = self.download_region(info)
                     
                     # Determine filename
-                    filename = f"{info['page']}_{i:04d}.jpg"
+                    filename = f"{info['page']}_{self.index_offset + i:04d}.jpg"
                     output_path = os.path.join(neume_dir, filename)
                     
                     # Save the image
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Annotation file validation shared by the integration scripts, and the
+HTTP session, request rate limiter and file saving shared by the
+downloaders.
+Parsed files are cached by path and modification time, so validating the
+same file twice, or reading it again after validation, does not re-parse it.
+"""
+
+import os
+import json
+import shutil
+import threading
+import time
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+def check_annotation_item(idx, item):
+    """Check a single annotation entry, printing the first problem found"""
+    if 'type' not in item:
+        print(f"✗ Error: Item {idx} missing 'type' field")
+        return False
+    if 'urls' not in item:
+        print(f"✗ Error: Item {idx} missing 'urls' field")
+        return False
+    if not isinstance(item['urls'], list):
+        print(f"✗ Error: Item {idx} 'urls' must be a list")
+        return False
+    return True
+
+def parse_annotations(file_path):
+    """Parse and check an annotations file, returning its entries or None"""
+    if ijson is not None:
+        # Stream the entries so a bad file is rejected at its first invalid
+        # entry without parsing the rest
+        with open(file_path, 'rb') as f:
+            if not f.peek(64)[:64].lstrip().startswith(b'['):
+                print("✗ Error: Annotations must be a list of objects")
+                return None
+            
+            data = []
+            for idx, item in enumerate(ijson.items(f, 'item')):
+                if not check_annotation_item(idx, item):
+                    return None
+                data.append(item)
+            return data
+    
+    with open(file_path, 'r') as f:
+        data = json.load(f)
+    
+    if not isinstance(data, list):
+        print("✗ Error: Annotations must be a list of objects")
+        return None
+    
+    for idx, item in enumerate(data):
+        if not check_annotation_item(idx, item):
+            return None
+    return data
+
+# Successfully parsed files by path, as (mtime, data); a failed parse is not
+# stored, so a file read while half-written is parsed again on the next call
+_parsed_annotations = {}
+
+def load_and_validate(file_path):
+    """Return (ok, data) for an annotations file, re-parsing it only if it changed"""
+    try:
+        mtime = os.path.getmtime(file_path)
+    except FileNotFoundError:
+        print(f"✗ Error: Annotations file not found: {file_path}")
+        return False, None
+    except OSError as e:
+        print(f"✗ Error validating annotations file: {e}")
+        return False, None
+    
+    cached = _parsed_annotations.get(file_path)
+    if cached is not None and cached[0] == mtime:
+        return True, cached[1]
+    
+    try:
+        data = parse_annotations(file_path)
+    except Exception as e:
+        print(f"✗ Error validating annotations file: {e}")
+        return False, None
+    if data is None:
+        return False, None
+    
+    _parsed_annotations[file_path] = (mtime, data)
+    return True, data
+
+def create_session(pool_size=8):
+    """Create one keep-alive session shared by a pool of `pool_size` download threads"""
+    # Imported here so the annotation helpers work without requests installed
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    session = requests.Session()
+    # One pooled connection per worker, so every thread reuses its TLS
+    # connection instead of opening a new one per image; 429 and 5xx
+    # responses are retried with backoff, honouring Retry-After
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.5,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          respect_retry_after_header=True)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class RateLimiter:
+    """Space request starts at least 1/rate seconds apart across all threads (rate 0: no limit)"""
+    
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+    
+    def wait(self):
+        """Block until this thread may start its next request"""
+        if not self.interval:
+            return
+        
+        # Reserve the next free slot under the lock, then sleep outside it
+        # so other threads can reserve the slots after this one
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def save_stream(stream, output_path, chunk_size=1 << 20):
+    """
+    Copy stream into output_path through a .part file that is only renamed
+    once the copy completes, so an interrupted download never leaves a
+    truncated file that a later run would take as finished
+    """
+    part_path = output_path + '.part'
+    try:
+        with open(part_path, 'wb') as f:
+            shutil.copyfileobj(stream, f, length=chunk_size)
+        os.replace(part_path, output_path)
+    except Exception:
+        try:
+            os.unlink(part_path)
+        except FileNotFoundError:
+            pass
+        raise
@@ -8,42 +8,39 @@ import os
 import json
 import argparse
 import sys
+import traceback
 import requests
 from pathlib import Path
 import re
 import time
 import csv
 
+# e.g. .../loris/csg/csg-0390/csg-0390_007.jp2/1425,1005,67,76/64,/0/default.jpg
+IIIF_URL_PATTERN = re.compile(
+    r'/(?P<manuscript>[^/]+)'
+    r'/(?P<page>[^/._]*(?:_(?P<page_number>[^/._]*))?[^/.]*)(?:\.[^/]*)?'
+    r'/(?P<x>\d+),(?P<y>\d+),(?P<width>\d+),(?P<height>\d+)/64,/0/default\.jpg'
+)
+
 def extract_neume_info(url, neume_type, index):
     """Extract information about a neume from its URL"""
-    # Extract coordinates
-    coords_match = re.search(r'(\d+),(\d+),(\d+),(\d+)/64,/0/default.jpg', url)
-    if not coords_match:
-        return None
-    
-    x = int(coords_match.group(1))
-    y = int(coords_match.group(2))
-    width = int(coords_match.group(3))
-    height = int(coords_match.group(4))
-    
-    # Extract manuscript and page info
-    url_parts = url.split('/')
-    if len(url_parts) < 7:
+    # Coordinates, manuscript and page all come out of a single match
+    match = IIIF_URL_PATTERN.search(url)
+    if not match:
         return None
     
-    manuscript = url_parts[5]  # e.g., csg-0390
-    page_full = url_parts[6].split('.')[0]  # e.g., csg-0390_007
-    page_number = page_full.split('_')[1] if '_' in page_full else page_full  # e.g., 007
+    page_full = match.group('page')  # e.g., csg-0390_007
+    page_number = match.group('page_number')  # e.g., 007
     
     return {
         'url': url,
-        'x': x,
-        'y': y,
-        'width': width,
-        'height': height,
-        'manuscript': manuscript,
+        'x': int(match.group('x')),
+        'y': int(match.group('y')),
+        'width': int(match.group('width')),
+        'height': int(match.group('height')),
+        'manuscript': match.group('manuscript'),  # e.g., csg-0390
         'page': page_full,
-        'page_number': page_number,
+        'page_number': page_number if page_number is not None else page_full,
         'neume_type': neume_type,
         'index': index
     }
@@ -162,7 +159,6 @@ def export_neumes(annotations_file, output_dir, filter_type=None, metadata_file=
         return True
     except Exception as e:
         print(f"Error exporting neumes: {e}")
-        import traceback
         traceback.print_exc()
         return False
 
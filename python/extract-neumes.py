@@ -1,17 +1,111 @@
 # extract_neumes.py
+import argparse
 import json
 import os
 import re
-import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import unquote
-import requests
 from PIL import Image
-from io import BytesIO
+from common import RateLimiter, create_session, save_stream
 
-def extract_neume_images():
+# Bounding box region of an annotation URL, e.g. /1425,1005,67,76/64,/0/default.jpg
+REGION_PATTERN = re.compile(r'/(\d+),(\d+),(\d+),(\d+)/64,/0/default\.jpg')
+
+# Page identifier in front of the region/size/rotation segments, e.g. csg-0390_007.jp2
+PAGE_ID_PATTERN = re.compile(r'/([^/]+)/[^/]+/[^/]+/[^/]+/default\.jpg$')
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+def load_annotations(path):
+    """Load the annotations list, salvaging complete entries from a damaged file"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except json.JSONDecodeError as e:
+        if ijson is None:
+            raise
+        print(f"Could not parse {path} ({e}), streaming complete entries instead")
+    
+    # Stream the top-level array and keep every entry before the damage
+    annotations = []
+    with open(path, 'rb') as f:
+        try:
+            for annotation in ijson.items(f, 'item'):
+                # Only keep entries that still carry their own type and URLs
+                if isinstance(annotation, dict) and 'type' in annotation and 'urls' in annotation:
+                    annotations.append(annotation)
+        except ijson.JSONError as e:
+            print(f"Stopped at malformed JSON after {len(annotations)} entries: {e}")
+    return annotations
+
+def neume_filename(url, i):
+    """Build the output file name for the i-th URL of a neume type"""
+    # Extract page identifier from URL
+    page_match = PAGE_ID_PATTERN.search(url)
+    page_id = page_match.group(1) if page_match else f"page_{i}"
+    return f"{page_id}_{i}.jpg"
+
+def link_or_copy(source, target):
+    """Hardlink target to source, copying when the filesystem can't link"""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(source, target)
+
+def extract_neume(session, url, output_paths, limiter=None):
+    """Download the region for one neume URL and save it to every output path"""
+    try:
+        # Split the URL into the image base and its bounding box region
+        region_match = REGION_PATTERN.search(url)
+        if not region_match:
+            print(f"Could not find coordinates in URL: {url}")
+            return False
+        
+        base_url = url[:region_match.start()]
+        x, y, width, height = (int(value) for value in region_match.groups())
+        
+        # Ask the server for just the neume region at its native width; it
+        # arrives as a finished JPEG, so no local decode/crop/re-encode is needed
+        region_url = f"{base_url}/{x},{y},{width},{height}/{width},/0/default.jpg"
+        
+        # Download the region
+        if limiter is not None:
+            limiter.wait()
+        response = session.get(region_url, stream=True, timeout=15)
+        if response.status_code != 200:
+            print(f"Failed to download {region_url}: {response.status_code}")
+            response.close()
+            return False
+        
+        # Save the neume image once, then link it into the other type
+        # directories; links are only made once the image is complete
+        output_path = output_paths[0]
+        response.raw.decode_content = True
+        if response.headers.get('Content-Type', '').startswith('image/jpeg'):
+            save_stream(response.raw, output_path, 1 << 20)
+        else:
+            # Some other format came back; convert it to JPEG
+            Image.open(response.raw).convert('RGB').save(output_path)
+        for target in output_paths[1:]:
+            link_or_copy(output_path, target)
+        print(f"Saved {output_path}" + (f" (+{len(output_paths) - 1} links)" if len(output_paths) > 1 else ""))
+        return True
+    except Exception as e:
+        print(f"Error processing {url}: {str(e)}")
+        return False
+
+def extract_neume_images(max_workers=16, rate=10):
     # 1. Load the annotations JSON file
-    with open('annotations.json', 'r') as f:
-        annotations = json.load(f)
+    annotations = load_annotations('annotations.json')
+    if not annotations:
+        print("Error: No usable annotations found in annotations.json")
+        return
     
     # Original output directory (commented out)
     # output_dir = 'extracted_neumes'
@@ -20,10 +114,16 @@ def extract_neume_images():
     output_dir = '/Volumes/Expansion/extracted_neumes'
     os.makedirs(output_dir, exist_ok=True)
     
-    # Process each annotation type
+    # The same region can be annotated under several neume types, so map
+    # each unique URL to every file it should end up in
+    url_targets = {}
+    total_images = 0
+    skipped = 0
     for annotation in annotations:
         neume_type = annotation['type']
-        print(f"Processing {neume_type} ({len(annotation['urls'])} images)")
+        urls = annotation['urls']
+        print(f"Processing {neume_type} ({len(urls)} images)")
+        total_images += len(urls)
         
         # Create directory for this neume type
         # Original path (commented out)
@@ -33,56 +133,50 @@ def extract_neume_images():
         neume_dir = os.path.join(output_dir, neume_type.replace(' ', '_'))
         os.makedirs(neume_dir, exist_ok=True)
         
-        # Process each URL
-        for i, url in enumerate(annotation['urls']):
-            try:
-                # Extract base URL (without the region parameter)
-                base_url = re.sub(r'/[\d]+,[\d]+,[\d]+,[\d]+/64,/0/default.jpg', '', url)
-                
-                # Extract bounding box coordinates
-                coords_match = re.search(r'([\d]+),([\d]+),([\d]+),([\d]+)', url)
-                if not coords_match:
-                    print(f"Could not find coordinates in URL: {url}")
-                    continue
-                    
-                x = int(coords_match.group(1))
-                y = int(coords_match.group(2))
-                width = int(coords_match.group(3))
-                height = int(coords_match.group(4))
-                
-                # Get the full image URL
-                full_image_url = f"{base_url}/full/max/0/default.jpg"
-                print(f"Downloading image {i+1}/{len(annotation['urls'])} for {neume_type}")
-                
-                # Download the full image
-                response = requests.get(full_image_url)
-                if response.status_code != 200:
-                    print(f"Failed to download {full_image_url}: {response.status_code}")
-                    continue
-                    
-                # Extract page identifier from URL
-                url_parts = url.split('/')
-                page_id = url_parts[6] if len(url_parts) > 6 else f"page_{i}"
-                
-                # Open and crop the image
-                img = Image.open(BytesIO(response.content))
-                cropped_img = img.crop((x, y, x + width, y + height))
-                
-                # Save the cropped image
-                # Original path (commented out)
-                # output_path = os.path.join(neume_dir, f"{page_id}_{i}.jpg")
-                
-                # New path on external drive
-                output_path = os.path.join(neume_dir, f"{page_id}_{i}.jpg")
-                cropped_img.save(output_path)
-                print(f"Saved {output_path}")
-                
-                # Add a small delay to avoid overwhelming the server
-                time.sleep(0.1)
-            except Exception as e:
-                print(f"Error processing {url}: {str(e)}")
+        # List the directory once so resumed runs skip finished images
+        # without a stat per URL
+        existing = {entry.name for entry in os.scandir(neume_dir)}
+        
+        for i, url in enumerate(urls):
+            filename = neume_filename(url, i)
+            if filename in existing:
+                skipped += 1
+                continue
+            url_targets.setdefault(url, []).append(os.path.join(neume_dir, filename))
+    
+    if skipped:
+        print(f"Skipping {skipped} images that already exist")
+    print(f"Downloading {len(url_targets)} unique images for {total_images - skipped} annotations")
     
+    # All images come from the same host, so share one connection pool
+    session = create_session(pool_size=max(32, max_workers))
+    
+    # One request rate for the whole pool; the default matches the old
+    # 0.1 s delay between sequential downloads
+    limiter = RateLimiter(rate)
+    
+    # Downloads are network-bound, so one thread pool serves every neume type
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(extract_neume, session, url, output_paths, limiter)
+            for url, output_paths in url_targets.items()
+        ]
+        saved = 0
+        for done, future in enumerate(as_completed(futures), 1):
+            if future.result():
+                saved += 1
+            if done % 100 == 0:
+                print(f"Progress: {done}/{len(futures)} images")
+    
+    print(f"Saved {saved}/{len(url_targets)} unique images")
     print("Extraction complete!")
 
 if __name__ == "__main__":
-    extract_neume_images()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Extract neume images from annotations.json')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Number of concurrent downloads (default: 16)')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='Maximum requests per second to the image server (default: 10, 0 for no limit)')
+    args = parser.parse_args()
+    
+    extract_neume_images(max_workers=args.workers, rate=args.rate)
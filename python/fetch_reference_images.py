@@ -10,52 +10,58 @@ import json
 import argparse
 import requests
 import sys
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from PIL import Image, ImageDraw
 from io import BytesIO
 import re
+from common import RateLimiter, create_session
+
+# Pages downloaded at a time
+DOWNLOAD_WORKERS = 8
+
+# e.g. http://www.e-codices.unifr.ch/loris/csg/csg-0390/csg-0390_007.jp2/1425,1005,67,76/64,/0/default.jpg
+IIIF_URL_PATTERN = re.compile(
+    r'^[^/]*//[^/]*/[^/]*/(?P<collection>[^/]*)/(?P<manuscript>[^/]*)/(?P<page>[^/.]*)[^/]*'
+    r'/(?P<x>\d+),(?P<y>\d+),(?P<width>\d+),(?P<height>\d+)/64,/0/default\.jpg'
+)
+
+@lru_cache(maxsize=None)
+def match_iiif_url(url):
+    """Match an IIIF URL once; manuscript info and coordinates share the match"""
+    return IIIF_URL_PATTERN.match(url)
 
 def extract_manuscript_info(url):
     """Extract manuscript and page information from an IIIF URL"""
-    try:
-        url_parts = url.split('/')
-        if len(url_parts) < 7:
-            return None
-        
-        manuscript = url_parts[5]  # e.g., csg-0390
-        page = url_parts[6].split('.')[0]  # e.g., csg-0390_007
-        return {
-            'manuscript': manuscript,
-            'page': page,
-            'full_url': f"http://www.e-codices.unifr.ch/loris/{url_parts[4]}/{manuscript}/{page}.jp2/full/1000,/0/default.jpg"
-        }
-    except Exception as e:
-        print(f"Error extracting manuscript info: {e}")
+    match = match_iiif_url(url)
+    if not match:
         return None
+    
+    manuscript = match.group('manuscript')  # e.g., csg-0390
+    page = match.group('page')  # e.g., csg-0390_007
+    return {
+        'manuscript': manuscript,
+        'page': page,
+        'full_url': f"http://www.e-codices.unifr.ch/loris/{match.group('collection')}/{manuscript}/{page}.jp2/full/1000,/0/default.jpg"
+    }
 
 def parse_iiif_url(url):
     """Parse an IIIF URL to extract coordinates"""
-    try:
-        coords_match = re.search(r'(\d+),(\d+),(\d+),(\d+)/64,/0/default.jpg', url)
-        if not coords_match:
-            return None
-        
-        return {
-            'x': int(coords_match.group(1)),
-            'y': int(coords_match.group(2)),
-            'width': int(coords_match.group(3)),
-            'height': int(coords_match.group(4))
-        }
-    except Exception as e:
-        print(f"Error parsing coordinates: {e}")
+    match = match_iiif_url(url)
+    if not match:
         return None
+    
+    return {
+        'x': int(match.group('x')),
+        'y': int(match.group('y')),
+        'width': int(match.group('width')),
+        'height': int(match.group('height'))
+    }
 
-def download_reference_image(info, output_dir):
-    """Download a reference image for a manuscript page"""
+def download_reference_image(info, output_dir, session=None, limiter=None):
+    """Download a reference image for a manuscript page, through session and limiter if they are given"""
     try:
-        # Create output directory
-        os.makedirs(output_dir, exist_ok=True)
-        
         # Generate filename
         filename = f"{info['page']}.jpg"
         output_path = os.path.join(output_dir, filename)
@@ -65,9 +71,12 @@ def download_reference_image(info, output_dir):
             print(f"Reference image already exists: {output_path}")
             return True, output_path
         
-        # Download image
+        # Download image; the timeout keeps a stalled server from holding
+        # a download thread forever
+        if limiter is not None:
+            limiter.wait()
         print(f"Downloading reference image from {info['full_url']}")
-        response = requests.get(info['full_url'])
+        response = (session or requests).get(info['full_url'], timeout=(3.05, 60))
         
         if response.status_code != 200:
             print(f"Failed to download reference image: {response.status_code}")
@@ -125,8 +134,11 @@ def create_overlay_image(reference_image_path, neume_coords, output_dir, neume_t
         print(f"Error creating overlay image: {e}")
         return False, None
 
-def fetch_reference_images(annotations_file, output_dir):
-    """Fetch reference images for all manuscripts and pages in the annotations"""
+def fetch_reference_images(annotations_file, output_dir, rate=4):
+    """
+    Fetch reference images for all manuscripts and pages in the annotations.
+    Page downloads are limited to `rate` requests per second (0: no limit).
+    """
     try:
         # Load annotations
         with open(annotations_file, 'r') as f:
@@ -134,7 +146,7 @@ def fetch_reference_images(annotations_file, output_dir):
         
         # Create output directory
         reference_dir = Path(output_dir)
-        reference_dir.mkdir(exist_ok=True)
+        reference_dir.mkdir(parents=True, exist_ok=True)
         
         # Track pages we've processed
         processed_pages = set()
@@ -173,33 +185,54 @@ def fetch_reference_images(annotations_file, output_dir):
                     page_neumes[page_key]['neume_types'][neume_type] = []
                 
                 page_neumes[page_key]['neume_types'][neume_type].append(coords)
-                
-                # Download reference image if not already processed
-                if page_key not in processed_pages:
-                    success, _ = download_reference_image(ms_info, str(reference_dir))
-                    if success:
-                        processed_pages.add(page_key)
         
-        # Create overlay images for each page and neume type
-        for page_key, page_data in page_neumes.items():
-            reference_image_path = reference_dir / f"{page_data['page']}.jpg"
-            if not reference_image_path.exists():
-                continue
+        # The parsed URLs are no longer needed
+        match_iiif_url.cache_clear()
+        
+        # Download pages on a thread pool and queue each page's overlays as soon
+        # as its image is on disk; drawing is CPU-bound, so it runs in worker
+        # processes while the remaining downloads are in flight
+        limiter = RateLimiter(rate)
+        with create_session(DOWNLOAD_WORKERS) as session, \
+                ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor, \
+                ProcessPoolExecutor(max_workers=os.cpu_count()) as overlay_pool:
+            futures = {
+                executor.submit(download_reference_image, page_data, str(reference_dir),
+                                session, limiter): page_key
+                for page_key, page_data in page_neumes.items()
+            }
             
-            for neume_type, coords_list in page_data['neume_types'].items():
-                create_overlay_image(
-                    str(reference_image_path),
-                    coords_list,
-                    str(reference_dir),
-                    neume_type.replace(' ', '_')
-                )
+            # Create overlay images for each page and neume type
+            overlay_futures = []
+            for future in as_completed(futures):
+                success, reference_image_path = future.result()
+                if not success:
+                    continue
+                
+                page_key = futures[future]
+                processed_pages.add(page_key)
+                
+                for neume_type, coords_list in page_neumes[page_key]['neume_types'].items():
+                    overlay_futures.append(overlay_pool.submit(
+                        create_overlay_image,
+                        reference_image_path,
+                        coords_list,
+                        str(reference_dir),
+                        neume_type.replace(' ', '_')
+                    ))
+            
+            # Wait for the remaining overlays
+            for future in as_completed(overlay_futures):
+                future.result()
         
         print(f"\nReference images fetched successfully!")
         print(f"Downloaded {len(processed_pages)} reference images")
         print(f"Created overlay images for {len(page_neumes)} pages")
         
-        # Generate HTML report
-        html_report = """
+        # Generate HTML report, writing each page straight to the file
+        report_path = reference_dir / "reference_images.html"
+        with open(report_path, 'w', buffering=1 << 20) as f:
+            f.write("""
         <!DOCTYPE html>
         <html>
         <head>
@@ -216,11 +249,11 @@ def fetch_reference_images(annotations_file, output_dir):
         </head>
         <body>
             <h1>Neume Reference Images</h1>
-        """
-        
-        # Add each page to the report
-        for page_key, page_data in sorted(page_neumes.items()):
-            html_report += f"""
+        """)
+            
+            # Add each page to the report
+            for page_key, page_data in sorted(page_neumes.items()):
+                f.write(f"""
             <div class="page-section">
                 <h2>{page_data['page']}</h2>
                 <div class="image-container">
@@ -228,33 +261,28 @@ def fetch_reference_images(annotations_file, output_dir):
                         <h3>Original Page</h3>
                         <img src="{page_data['page']}.jpg" alt="Original page">
                     </div>
-            """
-            
-            # Add overlay images for each neume type
-            for neume_type in page_data['neume_types'].keys():
-                safe_type = neume_type.replace(' ', '_')
-                overlay_filename = f"{page_data['page']}_overlay_{safe_type}.jpg"
-                html_report += f"""
+            """)
+                
+                # Add overlay images for each neume type
+                for neume_type in page_data['neume_types'].keys():
+                    safe_type = neume_type.replace(' ', '_')
+                    overlay_filename = f"{page_data['page']}_overlay_{safe_type}.jpg"
+                    f.write(f"""
                     <div class="image-card">
                         <h3>{neume_type} Overlay</h3>
                         <img src="{overlay_filename}" alt="{neume_type} overlay">
                     </div>
-                """
-            
-            html_report += """
+                """)
+                
+                f.write("""
                 </div>
             </div>
-            """
-        
-        html_report += """
+            """)
+            
+            f.write("""
         </body>
         </html>
-        """
-        
-        # Save HTML report
-        report_path = reference_dir / "reference_images.html"
-        with open(report_path, 'w') as f:
-            f.write(html_report)
+        """)
         
         print(f"HTML report created: {report_path}")
         
@@ -269,6 +297,8 @@ def main():
                        help='Path to annotations JSON file')
     parser.add_argument('--output', default='../public/reference_images',
                        help='Output directory for reference images')
+    parser.add_argument('--rate', type=float, default=4,
+                       help='Maximum requests per second to the image server (default: 4, 0 for no limit)')
     
     args = parser.parse_args()
     
@@ -276,7 +306,7 @@ def main():
     print(f"Annotations file: {args.annotations}")
     print(f"Output directory: {args.output}")
     
-    success = fetch_reference_images(args.annotations, args.output)
+    success = fetch_reference_images(args.annotations, args.output, args.rate)
     
     if success:
         print("\nReference images fetched successfully!")
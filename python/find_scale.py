@@ -5,8 +5,11 @@ This script creates multiple overlay images with different scaling factors.
 """
 
 import os
-import subprocess
+import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from overlay.fixed_overlay import generate, page_coordinates
 
 def main():
     parser = argparse.ArgumentParser(description='Find the right scaling factor')
@@ -35,26 +38,48 @@ def main():
     # Create output directory if it doesn't exist
     os.makedirs(args.output_dir, exist_ok=True)
     
-    # Generate overlays with different scales
-    for scale in scales:
-        output_filename = f"overlay_scale_{scale:.3f}.jpg"
-        output_path = os.path.join(args.output_dir, output_filename)
-        
-        print(f"\nGenerating overlay with scale factor {scale:.3f}")
-        command = [
-            'python', 'fixed_overlay.py',
-            '--annotations', args.annotations,
-            '--image', args.image,
-            '--output', output_path,
-            '--scale', str(scale),
-            '--debug-grid'
-        ]
-        
-        try:
-            subprocess.run(command, check=True)
+    # Parse the annotations once and share them with every scale, rather
+    # than having each overlay re-read the same JSON file
+    try:
+        with open(args.annotations, 'r') as f:
+            annotations = json.load(f)
+        print(f"Loaded {len(annotations)} annotation types")
+    except Exception as e:
+        print(f"Error loading annotations: {e}")
+        return 1
+    
+    # Only the scale changes between overlays, so parse the page's boxes
+    # out of the URLs once for the whole sweep
+    page_coords = page_coordinates(annotations, '007')
+    
+    # Decode the reference image once; every scale only draws over it
+    try:
+        base_img = Image.open(args.image).convert("RGB")
+    except Exception as e:
+        print(f"Error loading image: {e}")
+        return 1
+    
+    # Generate overlays with different scales on a thread pool sharing the
+    # decoded image (Pillow releases the GIL while compositing and encoding).
+    # These are throwaway previews, so they are encoded at a lower quality
+    jobs = [
+        (args.annotations, args.image,
+         os.path.join(args.output_dir, f"overlay_scale_{scale:.3f}.jpg"), scale, True)
+        for scale in scales
+    ]
+    print(f"\nGenerating {len(jobs)} overlays")
+    def render(job):
+        return generate(*job, base_img=base_img, quality=70, annotations=annotations,
+                        page_coords=page_coords)
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(len(jobs), os.cpu_count() or 1))) as executor:
+        results = list(executor.map(render, jobs))
+    
+    for (_, _, output_path, scale, _), result in zip(jobs, results):
+        if result == 0:
             print(f"Generated {output_path}")
-        except Exception as e:
-            print(f"Error generating overlay with scale {scale}: {e}")
+        else:
+            print(f"Error generating overlay with scale {scale:.3f}")
     
     # Create an HTML file to view all the overlays
     html_path = os.path.join(args.output_dir, "scale_comparison.html")
@@ -98,4 +123,4 @@ def main():
     return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -9,233 +9,176 @@ import os
 import json
 import argparse
 import sys
+import traceback
 import re
+import mmap
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-def streaming_parse_large_file(file_path):
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Errors raised by whichever JSON parser is in use (orjson's decode error
+# is a subclass of json.JSONDecodeError)
+JSON_ERRORS = (json.JSONDecodeError,) + ((ijson.JSONError,) if ijson else ())
+
+# Quoted http(s) URLs in raw annotation snippets
+URL_PATTERN_BYTES = re.compile(rb'"(https?://[^"]+)"')
+
+# Neume type at the start of an input file name, e.g. punctum_page7.txt
+FILENAME_TYPE_PATTERN = re.compile(r'^(\w+)[_\s-]')
+
+# A "type" declaration and the "urls" array that follows it in the same object
+BLOCK_PATTERN_BYTES = re.compile(rb'"type"\s*:\s*"([^"]+)"[^\[\]{}]*?"urls"\s*:\s*\[([^\]]*)\]')
+
+def parse_json_annotations(f):
+    """Parse a well-formed JSON file (opened in binary mode) into a list of valid neume entries"""
+    if ijson is not None:
+        # Stream the top-level array so only the entries we keep are held in
+        # memory, not the raw text and the whole parsed document
+        entries = ijson.items(f, 'item')
+    else:
+        data = orjson.loads(f.read()) if orjson is not None else json.load(f)
+        if isinstance(data, dict):
+            entries = [data]
+        elif isinstance(data, list):
+            entries = data
+        else:
+            entries = []
+    
+    return [entry for entry in entries
+            if isinstance(entry, dict) and "type" in entry and "urls" in entry]
+
+def scan_annotation_blocks(f, verbose=False):
     """
-    Parse a large file using line-by-line processing to identify neume types and their URLs.
+    Extract neume types and their URLs from a malformed or raw file
+    (opened in binary mode) with a regex scan over a read-only mapping.
     """
-    print(f"Processing large file: {file_path}")
+    # Each type maps to a dict used as an ordered set, so repeated URLs in
+    # pasted snippets are dropped on insertion
+    neume_data = defaultdict(dict)
     
-    try:
-        # First check if it's a well-formed JSON file
-        with open(file_path, 'r') as f:
-            first_line = f.readline().strip()
-            # If it starts with [ it might be a JSON array
-            if first_line.startswith('['):
-                try:
-                    # Try to parse as JSON
-                    f.seek(0)  # Go back to beginning
-                    data = json.load(f)
-                    if isinstance(data, list):
-                        valid_entries = []
-                        for entry in data:
-                            if isinstance(entry, dict) and "type" in entry and "urls" in entry:
-                                valid_entries.append(entry)
-                        
-                        if valid_entries:
-                            print(f"Successfully parsed JSON array with {len(valid_entries)} neume types")
-                            for entry in valid_entries:
-                                print(f"  - {entry['type']}: {len(entry['urls'])} URLs")
-                            return valid_entries
-                except json.JSONDecodeError as e:
-                    print(f"Not valid JSON: {e}")
-                    # Will continue with line-by-line parsing
-    except Exception as e:
-        print(f"Error checking file format: {e}")
+    # Scan the whole file through the mapping: no str decoding of the
+    # content, and no matches lost at chunk boundaries
+    if os.fstat(f.fileno()).st_size == 0:
+        print("File is empty")
+        return None
     
-    # Process line by line for very large files
-    print("Using line-by-line parsing for large file...")
-    
-    neume_data = {}  # Store neume type -> list of URLs
-    current_type = None
-    in_urls_block = False
-    url_buffer = []  # Buffer to collect URLs for current type
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # One pass pairs every type declaration with the URL array
+        # that follows it inside the same object
+        for match in BLOCK_PATTERN_BYTES.finditer(mm):
+            neume_type = match.group(1).decode('utf-8')
+            if verbose:
+                print(f"Found neume type: {neume_type}")
+            
+            urls = URL_PATTERN_BYTES.findall(match.group(2))
+            neume_data[neume_type].update(dict.fromkeys(url.decode('utf-8') for url in urls))
     
-    try:
-        with open(file_path, 'r') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                
-                # Skip empty lines
-                if not line:
-                    continue
-                
-                # Look for neume type declarations
-                type_match = re.search(r'"type"\s*:\s*"([^"]+)"', line)
-                if type_match:
-                    # If we were collecting URLs for a previous type, save them
-                    if current_type and url_buffer:
-                        neume_data[current_type] = url_buffer
-                        print(f"Collected {len(url_buffer)} URLs for {current_type}")
-                        url_buffer = []  # Clear buffer for new type
-                    
-                    current_type = type_match.group(1)
-                    in_urls_block = False
-                    print(f"Found neume type on line {line_num}: {current_type}")
-                
-                # Check for URLs array start
-                if current_type and '"urls"' in line and '[' in line:
-                    in_urls_block = True
-                    # If the line also contains URLs, extract them
-                    urls = re.findall(r'"(https?://[^"]+)"', line)
-                    url_buffer.extend(urls)
-                    continue
-                
-                # If we're in a URLs block, extract any URLs
-                if in_urls_block:
-                    urls = re.findall(r'"(https?://[^"]+)"', line)
-                    url_buffer.extend(urls)
-                    
-                    # Check if this is the end of the URLs block
-                    if ']' in line:
-                        if current_type:
-                            neume_data[current_type] = url_buffer
-                            print(f"Collected {len(url_buffer)} URLs for {current_type}")
-                            url_buffer = []
-                        in_urls_block = False
-        
-        # Make sure we save the last batch of URLs if the file ended
-        if current_type and url_buffer:
-            neume_data[current_type] = url_buffer
-            print(f"Collected {len(url_buffer)} URLs for {current_type}")
-        
-        # Convert to the expected list format
-        result = []
-        for neume_type, urls in neume_data.items():
-            result.append({
-                "type": neume_type,
-                "urls": urls
-            })
-        
-        if result:
-            print(f"Successfully extracted {len(result)} neume types")
-            return result
-        else:
-            print("No neume types were successfully extracted")
+    # Convert to the expected format
+    result = []
+    for neume_type, url_set in neume_data.items():
+        urls = list(url_set)
+        print(f"Extracted {neume_type}: {len(urls)} URLs")
+        result.append({
+            "type": neume_type,
+            "urls": urls
+        })
     
-    except Exception as e:
-        print(f"Error during line-by-line parsing: {e}")
-        import traceback
-        traceback.print_exc()
+    if result:
+        print(f"Successfully extracted {len(result)} neume types")
+        return result
     
-    # If we get here, try an even more basic approach
-    print("Trying simpler parsing approach...")
+    print("No neume types were successfully extracted")
+    return None
+
+def scan_urls(file_path):
+    """Return every quoted URL in a file, in order, from one memory-mapped regex pass"""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return [url.decode('utf-8') for url in URL_PATTERN_BYTES.findall(mm)]
+
+def streaming_parse_large_file(file_path, verbose=False):
+    """
+    Parse a large file to identify neume types and their URLs.
+    Files that look like JSON are parsed directly; anything else, or JSON
+    that fails to parse, goes through a single memory-mapped regex scan.
+    The file is opened once and shared by both parsers.
+    Per-type progress is only printed when verbose is set.
+    """
+    print(f"Processing large file: {file_path}")
     
     try:
-        # Read the first ~1000 bytes to try to identify the format
-        with open(file_path, 'r') as f:
-            start_text = f.read(1000)
-        
-        # Check if this looks like a raw JSON-like format with separate neume types
-        types = []
-        type_matches = re.finditer(r'"type"\s*:\s*"([^"]+)"', start_text)
-        types = [match.group(1) for match in type_matches]
-        
-        if types:
-            print(f"Found {len(types)} potential neume types in file start")
-            
-            # Process the file in larger chunks to extract all content
-            neume_data = defaultdict(list)
-            current_type = None
-            
-            with open(file_path, 'r') as f:
-                # Process chunk by chunk
-                chunk_size = 10 * 1024 * 1024  # 10MB chunks
-                chunk = f.read(chunk_size)
-                
-                while chunk:
-                    # Find all type declarations in this chunk
-                    for match in re.finditer(r'"type"\s*:\s*"([^"]+)"', chunk):
-                        type_pos = match.start()
-                        neume_type = match.group(1)
-                        
-                        # Find the URLs section for this type
-                        urls_start = chunk.find('"urls"', type_pos)
-                        if urls_start != -1:
-                            # Find opening bracket of URLs array
-                            bracket_pos = chunk.find('[', urls_start)
-                            if bracket_pos != -1:
-                                # Find the closing bracket of the URLs array
-                                # Need to handle nested brackets properly
-                                bracket_level = 1
-                                pos = bracket_pos + 1
-                                urls_end = -1
-                                
-                                while pos < len(chunk) and bracket_level > 0:
-                                    if chunk[pos] == '[':
-                                        bracket_level += 1
-                                    elif chunk[pos] == ']':
-                                        bracket_level -= 1
-                                        if bracket_level == 0:
-                                            urls_end = pos
-                                            break
-                                    pos += 1
-                                
-                                if urls_end != -1:
-                                    # Extract URLs from this section
-                                    urls_text = chunk[bracket_pos:urls_end+1]
-                                    urls = re.findall(r'"(https?://[^"]+)"', urls_text)
-                                    neume_data[neume_type].extend(urls)
-                    
-                    # Read next chunk
-                    chunk = f.read(chunk_size)
-            
-            # Convert to the expected format
-            result = []
-            for neume_type, urls in neume_data.items():
-                print(f"Extracted {neume_type}: {len(urls)} URLs")
-                result.append({
-                    "type": neume_type,
-                    "urls": urls
-                })
+        with open(file_path, 'rb') as f:
+            # Sniff the first non-whitespace character without consuming it
+            if f.peek(64)[:64].lstrip().startswith((b'[', b'{')):
+                try:
+                    valid_entries = parse_json_annotations(f)
+                    if valid_entries:
+                        print(f"Successfully parsed JSON array with {len(valid_entries)} neume types")
+                        for entry in valid_entries:
+                            print(f"  - {entry['type']}: {len(entry['urls'])} URLs")
+                        return valid_entries
+                except JSON_ERRORS as e:
+                    print(f"Not valid JSON: {e}")
+                    # Will continue with memory-mapped parsing
             
-            if result:
-                return result
-    
+            print("Using memory-mapped parsing for large file...")
+            return scan_annotation_blocks(f, verbose)
     except Exception as e:
-        print(f"Error during chunk parsing: {e}")
-        import traceback
+        print(f"Error parsing {file_path}: {e}")
         traceback.print_exc()
     
-    # Last resort - get all URLs without type information
-    print("WARNING: Falling back to extracting all URLs without type information")
-    
-    try:
-        urls = []
-        with open(file_path, 'r') as f:
-            for line in f:
-                line_urls = re.findall(r'"(https?://[^"]+)"', line)
-                urls.extend(line_urls)
-        
-        if urls:
-            print(f"Found {len(urls)} URLs with basic extraction (without type information)")
-            return [{
-                "type": "Unknown",
-                "urls": urls
-            }]
-    except Exception as e:
-        print(f"Error during basic URL extraction: {e}")
-    
     return None
 
-def save_annotations(annotations, output_file, append):
-    """Save the annotations to the output file"""
+def encode_annotation(annotation):
+    """Encode one annotation entry as indented JSON bytes"""
+    if orjson is not None:
+        # orjson encodes the whole entry in C, far faster than the stdlib
+        # encoder on entries with thousands of URLs
+        return orjson.dumps(annotation, option=orjson.OPT_INDENT_2)
+    return json.dumps(annotation, indent=2).encode('utf-8')
+
+def save_annotations(annotations, output_file, append, on_conflict='a', assume_yes=False):
+    """
+    Save the annotations to the output file.
+    on_conflict ('a', 'r' or 's') appends to, replaces or skips types already
+    in the output. Overwriting an existing output is only confirmed at an
+    interactive terminal; otherwise it needs assume_yes.
+    """
     existing = []
     
     # Load existing annotations if appending
     if append and os.path.exists(output_file):
         try:
-            with open(output_file, 'r') as f:
-                existing = json.load(f)
+            if orjson is not None:
+                with open(output_file, 'rb') as f:
+                    existing = orjson.loads(f.read())
+            else:
+                with open(output_file, 'r') as f:
+                    existing = json.load(f)
             print(f"Loaded {len(existing)} existing annotations from output file")
         except json.JSONDecodeError:
             print(f"Error: Output file exists but is not valid JSON. Creating new file.")
             existing = []
     
     # If not appending and file exists, confirm overwrite
-    if os.path.exists(output_file) and not append:
+    if os.path.exists(output_file) and not append and not assume_yes:
+        # Never wait on a prompt nobody can answer (e.g. when run from
+        # react_integration or a pipeline)
+        if not sys.stdin.isatty():
+            print(f"Output file {output_file} already exists; use --yes to overwrite it or --append to add to it")
+            return False
+        
         confirm = input(f"Output file {output_file} already exists. Overwrite? [y/N]: ").lower()
         if confirm != 'y':
             print("Operation cancelled")
@@ -248,44 +191,48 @@ def save_annotations(annotations, output_file, append):
     if append:
         final_annotations = existing.copy()
     
+    # Index existing entries by type once (the first entry wins, as the
+    # old linear scan did) so each new type is a single lookup
+    existing_by_type = {a["type"]: a for a in reversed(existing)}
+    # URL sets of existing entries, built on the first append to each type
+    # and kept up to date so a repeated type doesn't re-hash its URLs
+    seen_by_type = {}
+    
     # Process each new annotation
     for annotation in annotations:
         neume_type = annotation["type"]
         add_to_final = True
         
         # Check if this type already exists
-        for i, existing_annotation in enumerate(existing):
-            if existing_annotation["type"] == neume_type:
-                print(f"Neume type '{neume_type}' already exists in output file")
-                choice = input("Do you want to (a)ppend to it, (r)eplace it, or (s)kip? [a/r/s]: ").lower()
+        existing_annotation = existing_by_type.get(neume_type)
+        if existing_annotation is not None:
+            print(f"Neume type '{neume_type}' already exists in output file")
+            
+            if on_conflict == 'a':
+                # Append URLs to existing entry, skipping any already seen
+                seen = seen_by_type.get(neume_type)
+                if seen is None:
+                    seen = seen_by_type[neume_type] = set(existing_annotation["urls"])
+                added_urls = [url for url in annotation["urls"]
+                              if url not in seen and not seen.add(url)]
+                added = len(added_urls)
                 
-                if choice == 'a':
-                    # Append URLs to existing entry
-                    existing_urls = set(existing_annotation["urls"])
-                    new_urls = existing_annotation["urls"].copy()
-                    
-                    added = 0
-                    for url in annotation["urls"]:
-                        if url not in existing_urls:
-                            new_urls.append(url)
-                            added += 1
-                    
-                    if append:
-                        final_annotations[i]["urls"] = new_urls
-                    else:
-                        annotation["urls"] = new_urls
-                    
-                    print(f"Appended {added} new URLs to '{neume_type}'")
-                elif choice == 'r':
-                    # Replace existing entry
-                    if append:
-                        final_annotations[i]["urls"] = annotation["urls"]
-                    # For non-append mode, we'll add the new annotation and remove old ones later
-                elif choice == 's':
-                    # Skip this annotation
-                    add_to_final = False
+                if append:
+                    # The entry is shared with final_annotations, so extend it in place
+                    existing_annotation["urls"].extend(added_urls)
+                else:
+                    annotation["urls"] = existing_annotation["urls"] + added_urls
                 
-                break
+                print(f"Appended {added} new URLs to '{neume_type}'")
+            elif on_conflict == 'r':
+                # Replace existing entry
+                if append:
+                    existing_annotation["urls"] = annotation["urls"]
+                    seen_by_type.pop(neume_type, None)
+                # For non-append mode, we'll add the new annotation and remove old ones later
+            elif on_conflict == 's':
+                # Skip this annotation
+                add_to_final = False
         
         # Add new annotation if needed
         if add_to_final and not append:
@@ -293,36 +240,35 @@ def save_annotations(annotations, output_file, append):
     
     # For non-append mode, ensure uniqueness of types
     if not append:
-        # Create a new list with unique types (keeping the last one for each type)
-        unique_annotations = []
-        types_seen = set()
-        
-        for annotation in reversed(final_annotations):
-            if annotation["type"] not in types_seen:
-                unique_annotations.append(annotation)
-                types_seen.add(annotation["type"])
+        # Keep the last annotation for each type, at the position of its last
+        # occurrence: re-inserting a type moves it to the end of the dict
+        unique_annotations = {}
+        for annotation in final_annotations:
+            unique_annotations.pop(annotation["type"], None)
+            unique_annotations[annotation["type"]] = annotation
         
-        final_annotations = list(reversed(unique_annotations))
+        final_annotations = list(unique_annotations.values())
     
     # Write to output file with efficient streaming for large data
     print(f"Writing {len(final_annotations)} neume types to {output_file}...")
     
     try:
-        with open(output_file, 'w') as f:
+        # Write raw bytes through a 1 MB buffer; orjson already produces
+        # UTF-8, so nothing is decoded or re-encoded on the way out
+        with open(output_file, 'wb', buffering=1 << 20) as f:
             # Use a more efficient approach for very large data
-            f.write("[\n")
+            f.write(b"[\n")
             
             for i, annotation in enumerate(final_annotations):
-                # Write each annotation as JSON
-                json_str = json.dumps(annotation, indent=2)
+                f.write(encode_annotation(annotation))
                 
                 # Add comma for all but the last item
                 if i < len(final_annotations) - 1:
-                    f.write(json_str + ",\n")
+                    f.write(b",\n")
                 else:
-                    f.write(json_str + "\n")
+                    f.write(b"\n")
             
-            f.write("]\n")
+            f.write(b"]\n")
         
         print(f"Successfully saved annotations to {output_file}")
         for annotation in final_annotations:
@@ -346,11 +292,20 @@ def main():
                       help='Manually specify neume type if not found in the input')
     parser.add_argument('--batch', action='store_true',
                       help='Process multiple files (input should be a directory)')
+    parser.add_argument('--verbose', action='store_true',
+                      help='Print per-type parsing progress')
+    parser.add_argument('--on-conflict', choices=['append', 'replace', 'skip'], default='append',
+                      help='What to do with types already in the output file (default: append)')
+    parser.add_argument('--yes', action='store_true',
+                      help='Overwrite an existing output file without asking')
     
     args = parser.parse_args()
     
     print(f"=== Annotations Formatter (Large File Optimized) ===")
     
+    # save_annotations takes the same one-letter answers as its prompt
+    on_conflict = args.on_conflict[0]
+    
     if args.batch:
         if not os.path.isdir(args.input):
             print(f"Error: Input must be a directory when using --batch")
@@ -360,78 +315,72 @@ def main():
         success_count = 0
         failed_count = 0
         
-        for filename in os.listdir(args.input):
-            if filename.endswith('.txt') or filename.endswith('.json'):
-                input_file = os.path.join(args.input, filename)
-                
-                print(f"\nProcessing {filename}...")
-                
-                # Parse the file
-                annotations = streaming_parse_large_file(input_file)
+        # Parsing is CPU-bound and every file is independent, so parse them
+        # all in parallel; saving stays serial since each file updates the
+        # same output (and may ask before overwriting it, unless --yes is given)
+        filenames = [filename for filename in os.listdir(args.input)
+                     if filename.endswith('.txt') or filename.endswith('.json')]
+        input_files = [os.path.join(args.input, filename) for filename in filenames]
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            parsed = list(executor.map(streaming_parse_large_file, input_files,
+                                       [args.verbose] * len(input_files)))
+        
+        for filename, input_file, annotations in zip(filenames, input_files, parsed):
+            print(f"\nProcessing {filename}...")
+            
+            # If parsing failed but manual type is provided
+            if not annotations and args.type:
+                print(f"Using manually specified type: {args.type}")
+                # Extract every URL in one pass over the mapped file
+                urls = scan_urls(input_file)
                 
-                # If parsing failed but manual type is provided
-                if not annotations and args.type:
-                    print(f"Using manually specified type: {args.type}")
-                    urls = []
+                if urls:
+                    annotations = [{
+                        "type": args.type,
+                        "urls": urls
+                    }]
+                    print(f"Extracted {len(urls)} URLs for manual type")
+            
+            # If parsing failed and filename might contain type
+            if not annotations and not args.type:
+                name_match = FILENAME_TYPE_PATTERN.search(filename)
+                if name_match:
+                    neume_type = name_match.group(1)
+                    print(f"Using filename to detect type: {neume_type}")
                     
-                    # Extract URLs with line-by-line approach
-                    with open(input_file, 'r') as f:
-                        for line in f:
-                            urls.extend(re.findall(r'"(https?://[^"]+)"', line))
+                    # Extract every URL in one pass over the mapped file
+                    urls = scan_urls(input_file)
                     
                     if urls:
                         annotations = [{
-                            "type": args.type,
+                            "type": neume_type,
                             "urls": urls
                         }]
-                        print(f"Extracted {len(urls)} URLs for manual type")
-                
-                # If parsing failed and filename might contain type
-                if not annotations and not args.type:
-                    name_match = re.search(r'^(\w+)[_\s-]', filename)
-                    if name_match:
-                        neume_type = name_match.group(1)
-                        print(f"Using filename to detect type: {neume_type}")
-                        
-                        urls = []
-                        # Extract URLs with line-by-line approach
-                        with open(input_file, 'r') as f:
-                            for line in f:
-                                urls.extend(re.findall(r'"(https?://[^"]+)"', line))
-                        
-                        if urls:
-                            annotations = [{
-                                "type": neume_type,
-                                "urls": urls
-                            }]
-                            print(f"Extracted {len(urls)} URLs for filename type")
-                
-                if annotations:
-                    # Save annotations
-                    success = save_annotations(annotations, args.output, args.append)
-                    if success:
-                        success_count += 1
-                    else:
-                        failed_count += 1
+                        print(f"Extracted {len(urls)} URLs for filename type")
+            
+            if annotations:
+                # Save annotations
+                success = save_annotations(annotations, args.output, args.append,
+                                           on_conflict, args.yes)
+                if success:
+                    success_count += 1
                 else:
-                    print(f"Error: Could not parse file {filename}")
                     failed_count += 1
+            else:
+                print(f"Error: Could not parse file {filename}")
+                failed_count += 1
         
         print(f"\nBatch processing complete: {success_count} succeeded, {failed_count} failed")
     else:
         # Process a single file
         # Parse the file
-        annotations = streaming_parse_large_file(args.input)
+        annotations = streaming_parse_large_file(args.input, args.verbose)
         
         # If parsing failed but manual type is provided
         if not annotations and args.type:
             print(f"Using manually specified type: {args.type}")
-            urls = []
-            
-            # Extract URLs with line-by-line approach
-            with open(args.input, 'r') as f:
-                for line in f:
-                    urls.extend(re.findall(r'"(https?://[^"]+)"', line))
+            # Extract every URL in one pass over the mapped file
+            urls = scan_urls(args.input)
             
             if urls:
                 annotations = [{
@@ -442,7 +391,8 @@ def main():
         
         if annotations:
             # Save annotations
-            success = save_annotations(annotations, args.output, args.append)
+            success = save_annotations(annotations, args.output, args.append,
+                                       on_conflict, args.yes)
             if not success:
                 return 1
         else:
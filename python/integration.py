@@ -5,10 +5,10 @@ This script helps with data conversion and pipeline automation.
 """
 
 import os
-import json
+import sys
 import argparse
 import subprocess
-from advanced_iiif_extractor import IIIFExtractor
+from common import load_and_validate
 
 def check_dependencies():
     """Check if required Python packages are installed"""
@@ -24,30 +24,10 @@ def check_dependencies():
 
 def validate_annotations(file_path):
     """Validate the annotations JSON format"""
-    try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        
-        if not isinstance(data, list):
-            print("✗ Error: Annotations must be a list of objects")
-            return False
-        
-        for idx, item in enumerate(data):
-            if 'type' not in item:
-                print(f"✗ Error: Item {idx} missing 'type' field")
-                return False
-            if 'urls' not in item:
-                print(f"✗ Error: Item {idx} missing 'urls' field")
-                return False
-            if not isinstance(item['urls'], list):
-                print(f"✗ Error: Item {idx} 'urls' must be a list")
-                return False
-        
+    ok, data = load_and_validate(file_path)
+    if ok:
         print(f"✓ Annotations file validated: {len(data)} neume types found")
-        return True
-    except Exception as e:
-        print(f"✗ Error validating annotations file: {e}")
-        return False
+    return ok
 
 def start_react_app(app_dir):
     """Start the Vite React app for viewing and exporting annotations"""
@@ -58,19 +38,25 @@ def start_react_app(app_dir):
     print(f"Starting Vite React app in {app_dir}...")
     try:
         # For Vite, we use 'npm run dev' instead of 'npm start'
-        subprocess.Popen(['npm', 'run', 'dev'], cwd=app_dir)
-        print("✓ React app started. If it doesn't open automatically, visit http://localhost:3000 in your browser")
-        return True
+        print("✓ Starting React app. If it doesn't open automatically, visit http://localhost:3000 in your browser")
+        if os.name == 'nt':
+            # exec does not replace the process on Windows, so wait on npm instead
+            subprocess.run(['npm', 'run', 'dev'], cwd=app_dir, check=False)
+            return True
+        
+        # Nothing is left to do here once the dev server runs, so replace
+        # this Python process with npm rather than keeping it alive
+        sys.stdout.flush()
+        os.chdir(app_dir)
+        os.execvp('npm', ['npm', 'run', 'dev'])
     except Exception as e:
         print(f"✗ Error starting React app: {e}")
         return False
 
 def run_extraction(annotations_file, output_dir, workers=1):
     """Run the IIIF extraction process"""
-    if not os.path.exists(annotations_file):
-        print(f"✗ Error: Annotations file not found: {annotations_file}")
-        return False
-    
+    # Validation reports a missing file itself, from the same stat it uses
+    # for its cache key
     if not validate_annotations(annotations_file):
         return False
     
@@ -79,7 +65,6 @@ def run_extraction(annotations_file, output_dir, workers=1):
         # Use parallel extractor
         try:
             from parallel_extractor import main as parallel_main
-            import sys
             sys.argv = ['parallel_extractor.py', 
                         '--annotations', annotations_file,
                         '--output', output_dir,
@@ -90,8 +75,11 @@ def run_extraction(annotations_file, output_dir, workers=1):
             print(f"✗ Error running parallel extraction: {e}")
             return False
     else:
-        # Use standard extractor
+        # Use standard extractor (imported here, since it needs requests
+        # and Pillow, which the check command is meant to diagnose)
         try:
+            from advanced_iiif_extractor import IIIFExtractor
+            
             extractor = IIIFExtractor(
                 annotations_file=annotations_file,
                 output_dir=output_dir
@@ -8,76 +8,70 @@ This script:
 """
 
 import os
-import json
 import argparse
 import sys
+import random
 import subprocess
 from pathlib import Path
-from test_extractor import test_extraction, parse_iiif_url, download_image
+from common import load_and_validate
 
-def validate_annotations_file(file_path):
-    """Validate the structure of an annotations JSON file"""
-    try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        
-        if not isinstance(data, list):
-            print("✗ Error: Annotations must be a list of objects")
-            return False
-        
-        for idx, item in enumerate(data):
-            if 'type' not in item:
-                print(f"✗ Error: Item {idx} missing 'type' field")
-                return False
-            if 'urls' not in item:
-                print(f"✗ Error: Item {idx} missing 'urls' field")
-                return False
-            if not isinstance(item['urls'], list):
-                print(f"✗ Error: Item {idx} 'urls' must be a list")
-                return False
-            
-            # Validate first URL if available
-            if item['urls'] and len(item['urls']) > 0:
-                iiif_info = parse_iiif_url(item['urls'][0])
-                if not iiif_info:
-                    print(f"✗ Warning: Item {idx} has invalid IIIF URL format")
-        
-        print(f"✓ Annotations file validated: {len(data)} neume types found")
-        return True
-    except Exception as e:
-        print(f"✗ Error validating annotations file: {e}")
+def check_url_sample(data, n=10):
+    """Parse the first URL of up to n random items, warning about invalid ones"""
+    from test_extractor import parse_iiif_url
+    
+    items_with_urls = [(idx, item) for idx, item in enumerate(data) if item['urls']]
+    for idx, item in random.sample(items_with_urls, min(n, len(items_with_urls))):
+        if not parse_iiif_url(item['urls'][0]):
+            print(f"✗ Warning: Item {idx} has invalid IIIF URL format")
+
+def validate_annotations_file(file_path, strict=False):
+    """
+    Validate the structure of an annotations JSON file.
+    With strict, a random sample of the IIIF URLs is also parsed.
+    """
+    ok, data = load_and_validate(file_path)
+    if not ok:
         return False
+    
+    if strict:
+        check_url_sample(data)
+    
+    print(f"✓ Annotations file validated: {len(data)} neume types found")
+    return True
 
 def test_single_image(annotations_file, output_dir):
     """Test extracting a single image from the annotations file"""
+    # test_extractor needs requests and Pillow, so it is only imported once
+    # a step actually downloads
+    from test_extractor import parse_iiif_url, download_image
+    
     try:
-        # Load annotations
-        with open(annotations_file, 'r') as f:
-            data = json.load(f)
+        # Reuse the annotations parsed during validation rather than reading
+        # the file again
+        ok, data = load_and_validate(annotations_file)
+        if not ok:
+            return False
         
-        # Find the first URL
-        for item in data:
-            if item['urls'] and len(item['urls']) > 0:
-                url = item['urls'][0]
-                neume_type = item['type']
-                
-                print(f"Testing extraction of a {neume_type} image")
-                iiif_info = parse_iiif_url(url)
-                
-                if iiif_info:
-                    # Create output directory
-                    test_dir = os.path.join(output_dir, "single_test")
-                    success = download_image(iiif_info, test_dir, "test_image.jpg")
-                    
-                    if success:
-                        print(f"✓ Successfully downloaded test image to {test_dir}/test_image.jpg")
-                        return True
-                    else:
-                        print("✗ Failed to download test image")
-                        return False
+        # Find the first item whose first URL parses; the generators stop
+        # at the first match instead of walking the rest of the data
+        candidates = ((item, parse_iiif_url(item['urls'][0])) for item in data if item['urls'])
+        item, iiif_info = next(((item, info) for item, info in candidates if info), (None, None))
+        if item is None:
+            print("✗ No valid URLs found in the annotations file")
+            return False
         
-        print("✗ No valid URLs found in the annotations file")
-        return False
+        print(f"Testing extraction of a {item['type']} image")
+        
+        # Create output directory
+        test_dir = os.path.join(output_dir, "single_test")
+        success = download_image(iiif_info, test_dir, "test_image.jpg")
+        
+        if success:
+            print(f"✓ Successfully downloaded test image to {test_dir}/test_image.jpg")
+            return True
+        else:
+            print("✗ Failed to download test image")
+            return False
     except Exception as e:
         print(f"✗ Error testing single image: {e}")
         return False
@@ -109,6 +103,10 @@ def main():
                        help='Path to annotations JSON file')
     parser.add_argument('--output', default='./integration_test_output',
                        help='Output directory for test results')
+    parser.add_argument('--strict', action='store_true',
+                       help='Also check a sample of the IIIF URLs when validating')
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1),
+                       help='Number of parallel downloads in the bulk test (default: up to 8)')
     
     args = parser.parse_args()
     
@@ -123,7 +121,7 @@ def main():
     
     # Step 2: Validate annotations file
     print("Step 2: Validating annotations file...")
-    if not validate_annotations_file(args.annotations):
+    if not validate_annotations_file(args.annotations, args.strict):
         print("✗ Annotations file validation failed.")
         return 1
     print()
@@ -137,7 +135,8 @@ def main():
     
     # Step 4: Test bulk extraction (optional)
     print("Step 4: Testing bulk extraction...")
-    if not test_extraction(args.annotations, os.path.join(args.output, "bulk_test")):
+    from test_extractor import test_extraction
+    if not test_extraction(args.annotations, os.path.join(args.output, "bulk_test"), args.workers):
         print("✗ Bulk extraction test failed.")
         return 1
     print()
@@ -8,6 +8,7 @@ import os
 import json
 import argparse
 import sys
+import traceback
 from PIL import Image, ImageDraw, ImageFont
 import re
 
@@ -247,7 +248,6 @@ def main():
         return 0
     except Exception as e:
         print(f"Error creating overlay: {e}")
-        import traceback
         traceback.print_exc()
         return 1
 
@@ -8,7 +8,8 @@ import os
 import json
 import argparse
 import sys
-from PIL import Image, ImageDraw, ImageFont
+import traceback
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 import re
 
 def extract_coordinates(url):
@@ -71,7 +72,31 @@ def calculate_scale_factor(image_size, estimated_manuscript_size, manual_scale=N
     
     return scale
 
-def main():
+def draw_box(draw, box, fill, line_width, corner_size):
+    """Draw a bounding box outline with filled corner indicators"""
+    x0, y0, x1, y1 = box
+    
+    draw.rectangle(box, outline=fill, width=line_width)
+    
+    # Corner indicators for better visibility
+    draw.rectangle([x0, y0, x0 + corner_size, y0 + corner_size], fill=fill)
+    draw.rectangle([x1 - corner_size, y0, x1, y0 + corner_size], fill=fill)
+    draw.rectangle([x0, y1 - corner_size, x0 + corner_size, y1], fill=fill)
+    draw.rectangle([x1 - corner_size, y1 - corner_size, x1, y1], fill=fill)
+
+def find_label_font(font_size):
+    """Return a bold system font for box labels, or None if none is installed"""
+    # Try common system font locations
+    for font_path in [
+        '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',  # Linux
+        '/Library/Fonts/Arial Bold.ttf',  # macOS
+        'C:\\Windows\\Fonts\\arialbd.ttf'  # Windows
+    ]:
+        if os.path.exists(font_path):
+            return ImageFont.truetype(font_path, font_size)
+    return None
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Enhanced auto-scaling overlay generator')
     parser.add_argument('--annotations', default='../public/real-annotations.json',
                       help='Path to annotations JSON file')
@@ -88,7 +113,7 @@ def main():
     parser.add_argument('--line-width', type=int, default=10,
                        help='Width of bounding box lines (default: 10)')
     parser.add_argument('--line-color', default='red',
-                       help='Color of bounding boxes (red, green, blue, yellow, etc.)')
+                       help='Color of bounding boxes (any CSS color name or #rrggbb, default: red)')
     parser.add_argument('--corner-size', type=int, default=20,
                        help='Size of corner indicators (default: 20)')
     parser.add_argument('--scale', type=float, default=None,
@@ -102,26 +127,17 @@ def main():
     parser.add_argument('--web-size', type=int, default=1200,
                        help='Width of web-friendly version (default: 1200px)')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # Set web output path if not specified
     if args.web_output is None:
         args.web_output = args.output.replace('.jpg', '_web.jpg')
     
-    # Color mapping
-    color_map = {
-        'red': (255, 0, 0, args.opacity),
-        'green': (0, 255, 0, args.opacity),
-        'blue': (0, 0, 255, args.opacity),
-        'yellow': (255, 255, 0, args.opacity),
-        'purple': (128, 0, 128, args.opacity),
-        'cyan': (0, 255, 255, args.opacity),
-        'white': (255, 255, 255, args.opacity),
-        'black': (0, 0, 0, args.opacity),
-        'orange': (255, 165, 0, args.opacity)
-    }
-    
-    line_color = color_map.get(args.line_color.lower(), (255, 0, 0, args.opacity))  # Default to red
+    # Resolve the box color (any CSS color name or #rrggbb)
+    try:
+        line_color = ImageColor.getrgb(args.line_color)[:3]
+    except ValueError:
+        line_color = (255, 0, 0)  # Default to red
     
     print(f"=== Enhanced Auto-scaling Overlay Generator ===")
     print(f"Annotations file: {args.annotations}")
@@ -198,9 +214,20 @@ def main():
     
     # Create overlay
     try:
-        # Create a transparent overlay
-        overlay = Image.new('RGBA', image_size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
+        # Rasterize every box into a single-channel mask; the opacity is the
+        # mask value, so the color is applied in one paste at the end
+        mask = Image.new('L', image_size, 0)
+        draw = ImageDraw.Draw(mask)
+        
+        # Resolve the label font once rather than probing for it per box
+        font_size = 50  # Larger font size for big images
+        font = None
+        try:
+            font = find_label_font(font_size)
+        except Exception as e:
+            print(f"Warning: Couldn't load label font: {e}")
+        
+        pad = args.box_padding
         
         # Draw bounding boxes
         for i, neume in enumerate(neume_coords):
@@ -224,68 +251,37 @@ def main():
             width = min(width, image_size[0] - x)
             height = min(height, image_size[1] - y)
             
-            # Add padding
-            pad = args.box_padding
-            
-            # Draw rectangle
-            draw.rectangle(
-                [x-pad, y-pad, x + width+pad, y + height+pad],
-                outline=line_color,
-                width=args.line_width
-            )
-            
-            # Draw corner indicators for better visibility
-            corner_size = args.corner_size
-            # Top-left corner
-            draw.rectangle([x-pad, y-pad, x-pad + corner_size, y-pad + corner_size], fill=line_color)
-            # Top-right corner
-            draw.rectangle([x + width+pad - corner_size, y-pad, x + width+pad, y-pad + corner_size], fill=line_color)
-            # Bottom-left corner
-            draw.rectangle([x-pad, y + height+pad - corner_size, x-pad + corner_size, y + height+pad], fill=line_color)
-            # Bottom-right corner
-            draw.rectangle([x + width+pad - corner_size, y + height+pad - corner_size, x + width+pad, y + height+pad], fill=line_color)
+            # Draw padded rectangle with corner indicators
+            draw_box(draw, [x-pad, y-pad, x + width+pad, y + height+pad],
+                     args.opacity, args.line_width, args.corner_size)
             
-            # Add number label (if font available)
+            # Add number label
             try:
-                # Try to find a system font
-                font = None
-                font_size = 50  # Larger font size for big images
-                
-                # Try common system font locations
-                for font_path in [
-                    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',  # Linux
-                    '/Library/Fonts/Arial Bold.ttf',  # macOS
-                    'C:\\Windows\\Fonts\\arialbd.ttf'  # Windows
-                ]:
-                    if os.path.exists(font_path):
-                        font = ImageFont.truetype(font_path, font_size)
-                        break
-                
                 if font:
-                    # Draw with font
-                    draw.text((x + 10, y - font_size - 10), str(i+1), fill=line_color, font=font)
+                    draw.text((x + 10, y - font_size - 10), str(i+1), fill=args.opacity, font=font)
                 else:
                     # Draw without font (simple text)
-                    draw.text((x + 10, y - 50), str(i+1), fill=line_color)
+                    draw.text((x + 10, y - 50), str(i+1), fill=args.opacity)
             except Exception as e:
                 print(f"Warning: Couldn't add text label: {e}")
         
-        # Composite the overlay onto the original image
-        result = Image.alpha_composite(img.convert("RGBA"), overlay)
+        # Paint the box color through the mask; a mask value below 255 blends
+        # exactly like compositing an overlay of that alpha
+        result = img.convert("RGB")
+        result.paste(line_color, mask=mask)
         
         # Save the result
-        result.convert("RGB").save(args.output)
+        result.save(args.output)
         print(f"Saved overlay image to: {args.output}")
         
         # Generate a small version for web preview
         web_size = (args.web_size, int(args.web_size * image_size[1] / image_size[0]))  # Maintain aspect ratio
-        result.resize(web_size, Image.LANCZOS).convert("RGB").save(args.web_output)
+        result.resize(web_size, Image.LANCZOS).save(args.web_output)
         print(f"Saved web-friendly version to: {args.web_output}")
         
         return 0
     except Exception as e:
         print(f"Error creating overlay: {e}")
-        import traceback
         traceback.print_exc()
         return 1
 
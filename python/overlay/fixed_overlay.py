@@ -8,21 +8,53 @@ import os
 import json
 import argparse
 import sys
+import traceback
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
 import re
 
+# Bounding box region of an annotation URL, e.g. 1425,1005,67,76/64,/0/default.jpg
+COORDS_PATTERN = re.compile(r'(\d+),(\d+),(\d+),(\d+)/64,/0/default\.jpg')
+
 def extract_coordinates(url):
-    """Extract coordinates from an IIIF URL"""
-    match = re.search(r'(\d+),(\d+),(\d+),(\d+)/64,/0/default.jpg', url)
+    """Extract (x, y, width, height) from an IIIF URL"""
+    match = COORDS_PATTERN.search(url)
     if not match:
         return None
     
-    return {
-        'x': int(match.group(1)),
-        'y': int(match.group(2)),
-        'width': int(match.group(3)),
-        'height': int(match.group(4))
-    }
+    return tuple(map(int, match.groups()))
+
+@lru_cache(maxsize=None)
+def get_label_font():
+    """Load the label font once, falling back to Pillow's built-in font"""
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", 16)
+    except OSError:
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=None)
+def render_label(text):
+    """Rasterize a label once into an L mask that can be pasted in any color"""
+    font = get_label_font()
+    _, _, right, bottom = font.getbbox(text)
+    mask = Image.new('L', (right, bottom), 0)
+    ImageDraw.Draw(mask).text((0, 0), text, fill=255, font=font)
+    return mask
+
+def page_coordinates(annotations, filter_page):
+    """Return the unscaled (x, y, width, height) of every neume on one page"""
+    page_pattern = re.compile(rf"csg-0390_{re.escape(filter_page)}(?!\d)")
+    page_coords = []
+    for annotation in annotations:
+        for url in annotation['urls']:
+            if not page_pattern.search(url):
+                continue
+            
+            coords = extract_coordinates(url)
+            if coords:
+                page_coords.append(coords)
+    
+    return page_coords
 
 def draw_debug_grid(img, draw, grid_size=500):
     """Draw a debug grid on the image to help with coordinate visualization"""
@@ -42,55 +74,49 @@ def draw_debug_grid(img, draw, grid_size=500):
     for y in range(0, height, grid_size):
         draw.text((5, y + 5), str(y), fill=(0, 0, 255))
 
-def main():
-    parser = argparse.ArgumentParser(description='Fixed overlay generator')
-    parser.add_argument('--annotations', default='../public/real-annotations.json',
-                       help='Path to annotations JSON file')
-    parser.add_argument('--image', default='../public/reference_images/SG_390-007.jpg',
-                       help='Path to the reference image')
-    parser.add_argument('--output', default='../public/reference_images/SG_390-007_overlay_fixed.jpg',
-                       help='Path for the output overlay image')
-    parser.add_argument('--scale', type=float, default=0.2,
-                       help='Scale factor for coordinates (default: 0.2)')
-    parser.add_argument('--line-width', type=int, default=3,
-                       help='Width of the bounding box lines (default: 3)')
-    parser.add_argument('--debug-grid', action='store_true',
-                       help='Draw a debug grid on the image')
-    parser.add_argument('--filter-page', default='007',
-                       help='Only process URLs for this page number (default: 007)')
-    
-    args = parser.parse_args()
+def generate(annotations_path, image_path, output_path, scale=0.2, debug_grid=False,
+             line_width=3, filter_page='007', base_img=None, verbose=False,
+             quality=85, annotations=None, page_coords=None):
+    """Draw the neume boxes for one page onto the reference image and save it
     
+    base_img may be an already decoded RGB reference image; it is only read,
+    so callers can share one decode across several calls. Likewise
+    annotations may be the already parsed annotations list, in which case
+    annotations_path is not read, and page_coords may be the page's boxes
+    from page_coordinates(), so a sweep over scales parses the URLs only
+    once. quality is the JPEG quality of the saved overlay.
+    """
     print(f"=== Fixed Overlay Generator ===")
-    print(f"Annotations file: {args.annotations}")
-    print(f"Reference image: {args.image}")
-    print(f"Output image: {args.output}")
-    print(f"Scale factor: {args.scale}")
-    print(f"Line width: {args.line_width}")
-    print(f"Debug grid: {args.debug_grid}")
-    print(f"Filter page: {args.filter_page}")
+    print(f"Annotations file: {annotations_path}")
+    print(f"Reference image: {image_path}")
+    print(f"Output image: {output_path}")
+    print(f"Scale factor: {scale}")
+    print(f"Line width: {line_width}")
+    print(f"Debug grid: {debug_grid}")
+    print(f"Filter page: {filter_page}")
     
     # Check if files exist
-    if not os.path.exists(args.annotations):
-        print(f"Error: Annotations file not found: {args.annotations}")
+    if annotations is None and not os.path.exists(annotations_path):
+        print(f"Error: Annotations file not found: {annotations_path}")
         return 1
     
-    if not os.path.exists(args.image):
-        print(f"Error: Reference image not found: {args.image}")
+    if base_img is None and not os.path.exists(image_path):
+        print(f"Error: Reference image not found: {image_path}")
         return 1
     
     # Load annotations
-    try:
-        with open(args.annotations, 'r') as f:
-            annotations = json.load(f)
-        print(f"Loaded {len(annotations)} annotation types")
-    except Exception as e:
-        print(f"Error loading annotations: {e}")
-        return 1
+    if annotations is None:
+        try:
+            with open(annotations_path, 'r') as f:
+                annotations = json.load(f)
+            print(f"Loaded {len(annotations)} annotation types")
+        except Exception as e:
+            print(f"Error loading annotations: {e}")
+            return 1
     
     # Load image
     try:
-        img = Image.open(args.image).convert("RGBA")
+        img = base_img if base_img is not None else Image.open(image_path).convert("RGB")
         print(f"Loaded image: {img.width}x{img.height}")
         
         # Create overlay layer
@@ -101,80 +127,99 @@ def main():
         return 1
     
     # Draw debug grid if requested
-    if args.debug_grid:
+    if debug_grid:
         print("Drawing debug grid")
         draw_debug_grid(overlay, draw)
     
     # Process annotations
     try:
-        # Process only URLs for the specified page
+        # Parse the boxes for the specified page (unless the caller already
+        # did) and scale them up front, so the drawing loop below only
+        # issues ImageDraw calls
+        if page_coords is None:
+            page_coords = page_coordinates(annotations, filter_page)
+        
+        # Scale coordinates to match the reference image
+        boxes = [(coords,) + tuple(int(value * scale) for value in coords)
+                 for coords in page_coords]
+        
+        print(f"Found {len(boxes)} neumes for page {filter_page} across {len(annotations)} types")
+        
+        red = (255, 0, 0, 255)  # Red, fully opaque
+        yellow = (255, 255, 0, 255)
+        corner_size = 5
+        rectangle = draw.rectangle
+        
         count = 0
-        for annotation in annotations:
-            neume_type = annotation['type']
-            print(f"Processing {neume_type}")
+        for coords, x, y, width, height in boxes:
+            if verbose:
+                print(f"Neume {count+1}: Original coords: ({coords[0]},{coords[1]},{coords[2]},{coords[3]})")
+                print(f"Neume {count+1}: Scaled coords: ({x},{y},{width},{height})")
             
-            # Filter URLs for this specific page
-            page_urls = [url for url in annotation['urls'] if f"csg-0390_{args.filter_page}" in url]
-            print(f"Found {len(page_urls)} URLs for page {args.filter_page}")
+            # Draw rectangle with more visible style
+            rectangle([x, y, x + width, y + height], outline=red, width=line_width)
             
-            for i, url in enumerate(page_urls):
-                coords = extract_coordinates(url)
-                if not coords:
-                    continue
-                
-                # Scale coordinates to match the reference image
-                x = int(coords['x'] * args.scale)
-                y = int(coords['y'] * args.scale)
-                width = int(coords['width'] * args.scale)
-                height = int(coords['height'] * args.scale)
-                
-                print(f"Neume {count+1}: Original coords: ({coords['x']},{coords['y']},{coords['width']},{coords['height']})")
-                print(f"Neume {count+1}: Scaled coords: ({x},{y},{width},{height})")
-                
-                # Draw rectangle with more visible style
-                draw.rectangle(
-                    [x, y, x + width, y + height],
-                    outline=(255, 0, 0, 255),  # Red, fully opaque
-                    width=args.line_width
-                )
-                
-                # Add number label with more visible style
-                draw.text(
-                    (x, y-20), 
-                    str(count+1),
-                    fill=(255, 0, 0, 255),  # Red, fully opaque
-                    # Try different font options
-                    # font=ImageFont.truetype("arial.ttf", 20)  # Uncomment if available
-                )
-                
-                # Also draw indicators at corners for better visibility
-                corner_size = 5
-                # Top-left corner
-                draw.rectangle([x, y, x + corner_size, y + corner_size], fill=(255, 255, 0, 255))
-                # Top-right corner
-                draw.rectangle([x + width - corner_size, y, x + width, y + corner_size], fill=(255, 255, 0, 255))
-                # Bottom-left corner
-                draw.rectangle([x, y + height - corner_size, x + corner_size, y + height], fill=(255, 255, 0, 255))
-                # Bottom-right corner
-                draw.rectangle([x + width - corner_size, y + height - corner_size, x + width, y + height], fill=(255, 255, 0, 255))
-                
-                count += 1
+            # Add number label from the pre-rendered glyph mask
+            overlay.paste(red, (x, y-20), render_label(str(count+1)))
+            
+            # Also draw indicators at corners for better visibility
+            # Top-left corner
+            rectangle([x, y, x + corner_size, y + corner_size], fill=yellow)
+            # Top-right corner
+            rectangle([x + width - corner_size, y, x + width, y + corner_size], fill=yellow)
+            # Bottom-left corner
+            rectangle([x, y + height - corner_size, x + corner_size, y + height], fill=yellow)
+            # Bottom-right corner
+            rectangle([x + width - corner_size, y + height - corner_size, x + width, y + height], fill=yellow)
+            
+            count += 1
         
         print(f"Drew {count} neume boxes")
         
-        # Combine the original image and overlay
-        result = Image.alpha_composite(img.convert("RGBA"), overlay)
+        # Combine the original image and overlay by pasting the overlay
+        # through its own alpha; this blends like alpha_composite without
+        # RGBA copies of the whole page
+        result = img.copy()
+        result.paste(overlay, (0, 0), overlay)
         
-        # Save result
-        result.convert("RGB").save(args.output)
-        print(f"Saved overlay image to {args.output}")
+        # Save result with explicit JPEG settings; optimize and progressive
+        # would each add another pass over the encoded data
+        result.save(output_path, quality=quality, optimize=False,
+                    progressive=False, subsampling=2)
+        print(f"Saved overlay image to {output_path}")
         
         return 0
     except Exception as e:
         print(f"Error creating overlay: {e}")
-        import traceback
         traceback.print_exc()
         return 1
 
+def main():
+    parser = argparse.ArgumentParser(description='Fixed overlay generator')
+    parser.add_argument('--annotations', default='../public/real-annotations.json',
+                       help='Path to annotations JSON file')
+    parser.add_argument('--image', default='../public/reference_images/SG_390-007.jpg',
+                       help='Path to the reference image')
+    parser.add_argument('--output', default='../public/reference_images/SG_390-007_overlay_fixed.jpg',
+                       help='Path for the output overlay image')
+    parser.add_argument('--scale', type=float, default=0.2,
+                       help='Scale factor for coordinates (default: 0.2)')
+    parser.add_argument('--line-width', type=int, default=3,
+                       help='Width of the bounding box lines (default: 3)')
+    parser.add_argument('--debug-grid', action='store_true',
+                       help='Draw a debug grid on the image')
+    parser.add_argument('--filter-page', default='007',
+                       help='Only process URLs for this page number (default: 007)')
+    parser.add_argument('--verbose', action='store_true',
+                       help='Print the original and scaled coordinates of every neume')
+    parser.add_argument('--quality', type=int, default=85,
+                       help='JPEG quality of the output image (default: 85)')
+    
+    args = parser.parse_args()
+    
+    return generate(args.annotations, args.image, args.output, args.scale,
+                    args.debug_grid, args.line_width, args.filter_page,
+                    verbose=args.verbose, quality=args.quality)
+
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file
@@ -9,26 +9,39 @@ import os
 import json
 import argparse
 import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
 import re
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bounding box region of an annotation URL, e.g. 1425,1005,67,76/64,/0/default.jpg
+COORDS_PATTERN = re.compile(r'(\d+),(\d+),(\d+),(\d+)/64,/0/default\.jpg')
+
+# Rendering options the overlays in an output directory were drawn with, so a
+# rerun with different options redraws them even when no input has changed
+RENDER_OPTIONS_FILENAME = '.overlay_options.json'
+
 def parse_iiif_url(url):
     """Parse an IIIF URL to extract coordinates and page info"""
     try:
         # Extract coordinates using regex
-        coords_match = re.search(r'(\d+),(\d+),(\d+),(\d+)/64,/0/default.jpg', url)
+        coords_match = COORDS_PATTERN.search(url)
         if not coords_match:
             print(f"Invalid IIIF URL format: {url}")
             return None
         
-        x = int(coords_match.group(1))
-        y = int(coords_match.group(2))
-        width = int(coords_match.group(3))
-        height = int(coords_match.group(4))
+        x, y, width, height = map(int, coords_match.groups())
         
         # Extract manuscript and page information
-        url_parts = url.split('/')
+        # Only the first seven parts are needed, so the IIIF region/size/
+        # rotation tail is left unsplit
+        url_parts = url.split('/', 7)
         if len(url_parts) < 7:
             print(f"URL doesn't contain expected parts: {url}")
             return None
@@ -50,6 +63,15 @@ def parse_iiif_url(url):
         print(f"Error parsing IIIF URL: {e}")
         return None
 
+@lru_cache(maxsize=None)
+def list_reference_dir(reference_dir):
+    """List the reference directory once, so lookups are set probes rather than stats"""
+    try:
+        with os.scandir(reference_dir) as entries:
+            return frozenset(entry.name for entry in entries)
+    except OSError:
+        return frozenset()
+
 def find_reference_image(page_info, reference_dir):
     """Find the reference image file for a page"""
     # Try different possible filename formats
@@ -60,29 +82,123 @@ def find_reference_image(page_info, reference_dir):
         f"page_{page_info['page_number']}.jpg"     # page_007.jpg
     ]
     
+    reference_files = list_reference_dir(reference_dir)
     for filename in possible_filenames:
-        file_path = os.path.join(reference_dir, filename)
-        if os.path.exists(file_path):
-            return file_path
+        if filename in reference_files:
+            return os.path.join(reference_dir, filename)
     
     return None
 
-def create_overlay_image(reference_image_path, coords_list, output_dir, neume_type):
-    """Create an overlay image highlighting the neumes"""
+@lru_cache(maxsize=None)
+def get_label_font(size=20):
+    """Find and load the label font once, or None for Pillow's default font"""
+    from PIL import ImageFont
+    
     try:
-        if not os.path.exists(reference_image_path):
-            print(f"Reference image not found: {reference_image_path}")
-            return False, None
-        
-        # Load reference image
-        img = Image.open(reference_image_path).convert("RGB")
+        # Try to find a font that works on most systems
+        for system_font in [
+            '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',  # Linux
+            '/Library/Fonts/Arial Bold.ttf',  # macOS
+            'C:\\Windows\\Fonts\\arialbd.ttf'  # Windows
+        ]:
+            if os.path.exists(system_font):
+                return ImageFont.truetype(system_font, size)
+    except Exception:
+        pass  # Fall back to default font
+    
+    return None
+
+@lru_cache(maxsize=None)
+def render_label(text):
+    """Rasterize a label once into an L mask that can be pasted in any color"""
+    from PIL import Image, ImageDraw, ImageFont
+    
+    font = get_label_font() or ImageFont.load_default()
+    _, _, right, bottom = font.getbbox(text)
+    mask = Image.new('L', (right, bottom), 0)
+    ImageDraw.Draw(mask).text((0, 0), text, fill=255, font=font)
+    return mask
+
+def load_reference_image(reference_image_path, max_dim=None):
+    """
+    Decode a reference image as RGB. With max_dim, JPEG pages larger than
+    that are downscaled by 1/2, 1/4 or 1/8 inside libjpeg while decoding,
+    which skips most of the decode work.
+    """
+    from PIL import Image
+    
+    img = Image.open(reference_image_path)
+    if max_dim:
+        img.draft('RGB', (max_dim, max_dim))
+    return img.convert("RGB")
+
+def load_annotations(f):
+    """Decode the annotations from a file opened in binary mode"""
+    # orjson, when available, decodes large annotation files several times
+    # faster than json
+    if orjson is not None:
+        return orjson.loads(f.read())
+    return json.load(f)
+
+def overlay_output_path(reference_image_path, output_dir, neume_type, image_format='jpg'):
+    """Path of the overlay image for one reference page and neume type"""
+    page_basename = os.path.basename(reference_image_path).split('.')[0]
+    safe_neume_type = neume_type.replace(' ', '_')
+    output_filename = f"{page_basename}_overlay_{safe_neume_type}.{image_format}"
+    return os.path.join(output_dir, output_filename)
+
+def read_render_options(output_dir):
+    """Return the rendering options recorded in output_dir, or None if there are none"""
+    try:
+        with open(os.path.join(output_dir, RENDER_OPTIONS_FILENAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_render_options(output_dir, options):
+    """Record the rendering options the overlays in output_dir were drawn with"""
+    with open(os.path.join(output_dir, RENDER_OPTIONS_FILENAME), 'w') as f:
+        json.dump(options, f)
+
+def is_up_to_date(output_path, newest_input_mtime):
+    """Check whether output_path exists and is newer than every input"""
+    try:
+        return os.path.getmtime(output_path) >= newest_input_mtime
+    except OSError:
+        return False
+
+def create_overlay_image(reference_image_path, coords_list, output_dir, neume_type, base_img=None,
+                         image_format='jpg', max_dim=None, draw_on_base=False):
+    """
+    Create an overlay image highlighting the neumes.
+    base_img may be the already decoded reference image; it is copied, not
+    drawn on, so one decode can serve every neume type on the page, unless
+    draw_on_base is set because the caller has no further use for it.
+    image_format is 'jpg' or 'png'; max_dim is passed to load_reference_image.
+    """
+    # Pillow is imported where it is used, so --help and argument errors
+    # do not pay for loading it
+    from PIL import ImageDraw
+    
+    try:
+        if base_img is not None:
+            img = base_img if draw_on_base else base_img.copy()
+        else:
+            # Load reference image; a missing file surfaces from the open
+            # itself rather than from a separate existence check
+            try:
+                img = load_reference_image(reference_image_path, max_dim)
+            except FileNotFoundError:
+                print(f"Reference image not found: {reference_image_path}")
+                return False, None
         draw = ImageDraw.Draw(img)
         
         # Try to determine scaling factor based on image dimensions vs original manuscript
         # For demonstration, we'll use a reasonable estimate
         # You may need to adjust this based on your specific images
         
-        # Get image dimensions
+        # Get image dimensions (as decoded, so the scale follows any draft
+        # reduction)
         img_width, img_height = img.size
         
         # Assuming original manuscript is around 5000px wide for high-res IIIF
@@ -90,58 +206,51 @@ def create_overlay_image(reference_image_path, coords_list, output_dir, neume_ty
         orig_width = 5000
         scale_factor = img_width / orig_width
         
-        # Draw rectangles for each neume
-        for i, coords in enumerate(coords_list):
+        # Scale and clip every box up front, so the drawing loop below only
+        # issues ImageDraw calls (each of which fills its edges in C)
+        boxes = []
+        max_x = img_width - 1
+        max_y = img_height - 1
+        padding = 5
+        for coords in coords_list:
             # Scale coordinates
             x = int(coords['x'] * scale_factor)
             y = int(coords['y'] * scale_factor)
             width = int(coords['width'] * scale_factor)
             height = int(coords['height'] * scale_factor)
             
-            # Ensure coordinates are within image bounds
-            x = max(0, min(x, img_width - 1))
-            y = max(0, min(y, img_height - 1))
+            # Ensure coordinates are within image bounds (the parsed values
+            # are unsigned, so only the upper bounds can be exceeded)
+            x = min(x, max_x)
+            y = min(y, max_y)
             width = min(width, img_width - x)
             height = min(height, img_height - y)
             
-            # Draw rectangle with some padding
-            padding = 5
-            draw.rectangle(
-                [x-padding, y-padding, x+width+padding, y+height+padding],
-                outline=(255, 0, 0),  # Red
-                width=2
-            )
-            
-            # Add a number label
-            # Try to load a font, fall back to default if not available
-            font = None
-            try:
-                # Try to find a font that works on most systems
-                font_path = None
-                for system_font in [
-                    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',  # Linux
-                    '/Library/Fonts/Arial Bold.ttf',  # macOS
-                    'C:\\Windows\\Fonts\\arialbd.ttf'  # Windows
-                ]:
-                    if os.path.exists(system_font):
-                        font_path = system_font
-                        break
-                
-                if font_path:
-                    font = ImageFont.truetype(font_path, 20)
-            except Exception:
-                pass  # Fall back to default font
+            # Keep the padded outline and the label position, ready to draw
+            boxes.append(((x-padding, y-padding, x+width+padding, y+height+padding), (x, y-25)))
+        
+        rectangle = draw.rectangle
+        red = (255, 0, 0)
+        
+        # Draw rectangles for each neume; Pillow fills the outline edges as
+        # spans in C, so one call per box is all the drawing takes
+        for i, (outline_box, label_position) in enumerate(boxes):
+            rectangle(outline_box, outline=red, width=2)
             
-            # Draw text
-            text_position = (x, y-25)
-            draw.text(text_position, str(i+1), fill=(255, 0, 0), font=font)
+            # Add a number label from the pre-rendered glyph mask, so each
+            # number is rasterized once per process rather than once per box
+            img.paste(red, label_position, render_label(str(i+1)))
         
         # Save the overlay image
-        page_basename = os.path.basename(reference_image_path).split('.')[0]
-        safe_neume_type = neume_type.replace(' ', '_')
-        output_filename = f"{page_basename}_overlay_{safe_neume_type}.jpg"
-        output_path = os.path.join(output_dir, output_filename)
-        img.save(output_path)
+        output_path = overlay_output_path(reference_image_path, output_dir, neume_type, image_format)
+        if image_format == 'png':
+            # Fastest zlib level; the overlays are mostly flat colour
+            img.save(output_path, compress_level=1)
+        else:
+            # Explicit JPEG settings: 4:2:2 subsampling keeps the thin red
+            # edges sharper than the 4:2:0 default, and no optimize pass
+            img.save(output_path, quality=85, subsampling=1, optimize=False,
+                     progressive=False)
         print(f"Created overlay image: {output_path}")
         
         return True, output_path
@@ -149,8 +258,58 @@ def create_overlay_image(reference_image_path, coords_list, output_dir, neume_ty
         print(f"Error creating overlay image: {e}")
         return False, None
 
-def generate_overlays(annotations_file, reference_dir, output_dir=None):
-    """Generate overlay images for neumes"""
+def render_page_overlays(reference_image_path, type_neumes, output_dir, image_format='jpg',
+                         annotations_mtime=None, max_dim=None):
+    """
+    Decode one reference page and create the overlay for every neume type on
+    it. Returns a list of (neume_type, success, overlay_path).
+    If annotations_mtime is given, overlays newer than both it and the
+    reference image are kept as they are, and the page is only decoded when
+    at least one overlay needs redrawing.
+    """
+    outputs = [(neume_type, neumes,
+                overlay_output_path(reference_image_path, output_dir, neume_type, image_format))
+               for neume_type, neumes in type_neumes.items()]
+    
+    current = set()
+    if annotations_mtime is not None:
+        newest_input_mtime = max(os.path.getmtime(reference_image_path), annotations_mtime)
+        current = {output_path for _, _, output_path in outputs
+                   if is_up_to_date(output_path, newest_input_mtime)}
+    
+    base_img = None
+    if len(current) < len(outputs):
+        try:
+            base_img = load_reference_image(reference_image_path, max_dim)
+        except Exception as e:
+            print(f"Error loading reference image {reference_image_path}: {e}")
+    
+    # The last overlay drawn for the page can use the decoded page itself,
+    # saving one full-page copy per page
+    last_stale_path = next((output_path for _, _, output_path in reversed(outputs)
+                            if output_path not in current), None)
+    
+    results = []
+    for neume_type, neumes, output_path in outputs:
+        if output_path in current:
+            print(f"Overlay up to date: {output_path}")
+            results.append((neume_type, True, output_path))
+        elif base_img is None:
+            results.append((neume_type, False, None))
+        else:
+            results.append((neume_type,) + create_overlay_image(reference_image_path, neumes, output_dir,
+                                                                neume_type, base_img, image_format,
+                                                                draw_on_base=output_path == last_stale_path))
+    
+    return results
+
+def generate_overlays(annotations_file, reference_dir, output_dir=None, image_format='jpg',
+                      max_dim=None):
+    """
+    Generate overlay images for neumes.
+    annotations_file is a path or an already open binary file (as argparse
+    hands it over).
+    """
     try:
         # Set output directory
         if output_dir is None:
@@ -159,12 +318,25 @@ def generate_overlays(annotations_file, reference_dir, output_dir=None):
         # Create output directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
         
-        # Load annotations
-        with open(annotations_file, 'r') as f:
-            annotations = json.load(f)
+        # Load annotations. Overlays older than the annotations are redrawn
+        # even if the reference image has not changed, so keep their mtime
+        if hasattr(annotations_file, 'read'):
+            annotations = load_annotations(annotations_file)
+            annotations_mtime = os.fstat(annotations_file.fileno()).st_mtime
+        else:
+            with open(annotations_file, 'rb') as f:
+                annotations = load_annotations(f)
+            annotations_mtime = os.path.getmtime(annotations_file)
         
         print(f"Loaded {len(annotations)} neume types")
         
+        # Existing overlays only count as current if they were drawn with the
+        # same options; otherwise every overlay is redrawn
+        render_options = {'max_dim': max_dim or 0}
+        if read_render_options(output_dir) != render_options:
+            print(f"Rendering options changed to {render_options}, redrawing all overlays")
+            annotations_mtime = None
+        
         # Process each neume type
         results = {
             'success': True,
@@ -172,54 +344,61 @@ def generate_overlays(annotations_file, reference_dir, output_dir=None):
             'errors': []
         }
         
+        # Group neumes by page first, across all types, so each reference
+        # image is decoded once however many neume types it contains
+        page_types = {}
+        
         for annotation in annotations:
             neume_type = annotation['type']
             print(f"\nProcessing {neume_type} ({len(annotation['urls'])} images)")
             
-            # Group neumes by page
-            page_neumes = {}
-            
             for url in annotation['urls']:
                 neume_info = parse_iiif_url(url)
                 if not neume_info:
                     continue
                 
                 page_key = f"{neume_info['manuscript']}_{neume_info['page_number']}"
-                if page_key not in page_neumes:
-                    page_neumes[page_key] = []
-                
-                page_neumes[page_key].append(neume_info)
-            
-            # Create overlay for each page
-            for page_key, neumes in page_neumes.items():
+                page_types.setdefault(page_key, {}).setdefault(neume_type, []).append(neume_info)
+        
+        # Create overlay for each page. Pages are independent and decoding,
+        # drawing and encoding them is CPU-bound, so they run on a process
+        # pool; results are collected in page order
+        render_failed = False
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            page_futures = []
+            for page_key, type_neumes in page_types.items():
                 # Get a representative neume to find the page
-                if not neumes:
-                    continue
-                
-                reference_image_path = find_reference_image(neumes[0], reference_dir)
+                first_neumes = next(iter(type_neumes.values()))
+                reference_image_path = find_reference_image(first_neumes[0], reference_dir)
                 if not reference_image_path:
                     error_msg = f"Reference image not found for {page_key}"
                     print(f"✗ {error_msg}")
                     results['errors'].append(error_msg)
                     continue
                 
-                # Create overlay
-                success, overlay_path = create_overlay_image(
-                    reference_image_path,
-                    neumes,
-                    output_dir,
-                    neume_type
-                )
-                
-                if success:
-                    results['overlays_created'].append(overlay_path)
-                else:
-                    error_msg = f"Failed to create overlay for {page_key}, {neume_type}"
-                    print(f"✗ {error_msg}")
-                    results['errors'].append(error_msg)
+                future = executor.submit(render_page_overlays, reference_image_path,
+                                         type_neumes, output_dir, image_format,
+                                         annotations_mtime, max_dim)
+                page_futures.append((page_key, future))
+            
+            for page_key, future in page_futures:
+                for neume_type, success, overlay_path in future.result():
+                    if success:
+                        results['overlays_created'].append(overlay_path)
+                    else:
+                        render_failed = True
+                        error_msg = f"Failed to create overlay for {page_key}, {neume_type}"
+                        print(f"✗ {error_msg}")
+                        results['errors'].append(error_msg)
+        
+        # Only record the options once every overlay has been drawn with them;
+        # a failed one may still be an old file drawn with other options
+        if not render_failed:
+            write_render_options(output_dir, render_options)
         
-        # Generate HTML report
-        html_report = """
+        # Generate HTML report; the pieces are collected in a list and joined
+        # once rather than re-copying the growing string for every card
+        html_parts = ["""
         <!DOCTYPE html>
         <html>
         <head>
@@ -235,47 +414,55 @@ def generate_overlays(annotations_file, reference_dir, output_dir=None):
         </head>
         <body>
             <h1>Neume Overlay Report</h1>
-        """
+        """]
+        
+        # Read the output directory once and bucket the overlays by the
+        # neume type in their <page>_overlay_<type>.<ext> names
+        overlay_suffix = f".{image_format}"
+        overlays_by_type = defaultdict(list)
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(overlay_suffix) and '_overlay_' in entry.name:
+                    safe_type = entry.name.partition('_overlay_')[2][:-len(overlay_suffix)]
+                    overlays_by_type[safe_type].append(entry.name)
         
         for annotation in annotations:
             neume_type = annotation['type']
-            html_report += f"""
+            html_parts.append(f"""
             <div class="neume-type">
                 <h2>{neume_type}</h2>
                 <div class="image-container">
-            """
+            """)
             
             # Find all overlay images for this neume type
             safe_neume_type = neume_type.replace(' ', '_')
-            overlay_pattern = f"*_overlay_{safe_neume_type}.jpg"
-            overlay_files = list(Path(output_dir).glob(overlay_pattern))
             
-            for overlay_file in overlay_files:
+            for overlay_name in overlays_by_type.get(safe_neume_type, ()):
                 # Get the base filename without the overlay part
-                base_name = str(overlay_file.name).split('_overlay_')[0]
+                base_name = overlay_name.split('_overlay_')[0]
                 original_file = Path(reference_dir) / f"{base_name}.jpg"
                 
-                html_report += f"""
+                html_parts.append(f"""
                     <div class="image-card">
                         <h3>{base_name} - {neume_type}</h3>
-                        <img src="{overlay_file.name}" alt="Overlay for {base_name}">
+                        <img src="{overlay_name}" alt="Overlay for {base_name}">
                     </div>
-                """
+                """)
             
-            html_report += """
+            html_parts.append("""
                 </div>
             </div>
-            """
+            """)
         
-        html_report += """
+        html_parts.append("""
         </body>
         </html>
-        """
+        """)
         
         # Save HTML report
         report_path = os.path.join(output_dir, "overlay_report.html")
         with open(report_path, 'w') as f:
-            f.write(html_report)
+            f.write("".join(html_parts))
         
         print(f"HTML report created: {report_path}")
         
@@ -293,20 +480,27 @@ def generate_overlays(annotations_file, reference_dir, output_dir=None):
 def main():
     parser = argparse.ArgumentParser(description='Generate overlay images for neumes')
     parser.add_argument('--annotations', default='../public/real-annotations.json',
+                       type=argparse.FileType('rb'),
                        help='Path to annotations JSON file')
     parser.add_argument('--reference-dir', default='../public/reference_images',
                        help='Directory containing reference images')
     parser.add_argument('--output-dir', default=None,
                        help='Output directory for overlay images (defaults to reference_dir)')
+    parser.add_argument('--format', choices=['jpg', 'png'], default='jpg',
+                       help='Image format of the overlays (default: jpg)')
+    parser.add_argument('--max-dim', type=int, default=2048,
+                       help='Decode reference JPEGs at a reduced size when they are larger than this '
+                            '(default: 2048, 0 for full resolution)')
     
     args = parser.parse_args()
     
     print("=== Generating Neume Overlays ===")
-    print(f"Annotations file: {args.annotations}")
+    print(f"Annotations file: {args.annotations.name}")
     print(f"Reference directory: {args.reference_dir}")
     print(f"Output directory: {args.output_dir or args.reference_dir}")
     
-    results = generate_overlays(args.annotations, args.reference_dir, args.output_dir)
+    results = generate_overlays(args.annotations, args.reference_dir, args.output_dir,
+                                args.format, args.max_dim)
     
     if results['success']:
         print(f"\nOverlay generation completed successfully!")
@@ -5,8 +5,17 @@ import argparse
 import concurrent.futures
 from python.advanced_iiif_extractor import IIIFExtractor
 
-def process_annotation_batch(annotation, output_dir, batch_id):
-    """Process a single annotation batch"""
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# URLs handed to a worker at a time; small enough that one large neume
+# type is spread over every worker instead of pinning a single one
+URLS_PER_BATCH = 64
+
+def process_annotation_batch(annotation, output_dir, batch_id, start=0):
+    """Process a single annotation batch whose first URL is number `start` of its type"""
     extractor = IIIFExtractor(
         annotations_file=None,  # We're passing the annotation directly
         output_dir=os.path.join(output_dir, f"batch_{batch_id}")
@@ -15,6 +24,9 @@ def process_annotation_batch(annotation, output_dir, batch_id):
     # Set the annotation directly
     extractor.annotations = [annotation]
     
+    # Number the images from the batch's position within its type
+    extractor.index_offset = start
+    
     # Extract the images
     extractor.extract_all()
     
@@ -28,24 +40,34 @@ def main():
     args = parser.parse_args()
     
     # Load annotations
-    with open(args.annotations, 'r') as f:
-        annotations = json.load(f)
+    with open(args.annotations, 'rb') as f:
+        annotations = orjson.loads(f.read()) if orjson is not None else json.load(f)
     
-    print(f"Processing {len(annotations)} annotation types with {args.workers} workers")
+    # Split every type into fixed-size batches of URLs, so the work is
+    # balanced across workers however skewed the types are; each batch keeps
+    # the index of its first URL so filenames stay unique within the type
+    batches = [({'type': annotation['type'], 'urls': annotation['urls'][start:start + URLS_PER_BATCH]}, start)
+               for annotation in annotations
+               for start in range(0, len(annotation['urls']), URLS_PER_BATCH)]
+    
+    print(f"Processing {len(annotations)} annotation types in {len(batches)} batches with {args.workers} workers")
     
     # Create main output directory
     os.makedirs(args.output, exist_ok=True)
     
-    # Process annotations in parallel
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+    # Downloads spend their time waiting on the network, and Pillow releases
+    # the GIL while decoding and saving, so threads avoid the cost of
+    # starting processes and pickling every batch
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
         futures = []
         
-        for i, annotation in enumerate(annotations):
+        for i, (batch, start) in enumerate(batches):
             future = executor.submit(
                 process_annotation_batch, 
-                annotation, 
+                batch, 
                 args.output, 
-                i
+                i,
+                start
             )
             futures.append(future)
         
@@ -66,8 +88,8 @@ def main():
 
 def merge_metadata(base_dir):
     """Merge all metadata CSV files into one"""
-    import csv
     import glob
+    import shutil
     
     # Find all metadata files
     metadata_files = glob.glob(os.path.join(base_dir, "batch_*/neume_metadata.csv"))
@@ -78,23 +100,17 @@ def merge_metadata(base_dir):
     # Prepare merged file
     merged_file = os.path.join(base_dir, "neume_metadata.csv")
     
-    # Get header from first file
-    with open(metadata_files[0], 'r', newline='') as f:
-        reader = csv.reader(f)
-        header = next(reader)
-    
-    # Write merged file
-    with open(merged_file, 'w', newline='') as outfile:
-        writer = csv.writer(outfile)
-        writer.writerow(header)
+    # Every batch is written by the same extractor with the same header, so
+    # the files can be concatenated as bytes: copy the first whole, and the
+    # rest without their header line (csv.writer terminates every row)
+    with open(merged_file, 'wb') as outfile:
+        with open(metadata_files[0], 'rb') as infile:
+            shutil.copyfileobj(infile, outfile, length=1 << 20)
         
-        # Append data from each file
-        for file_path in metadata_files:
-            with open(file_path, 'r', newline='') as infile:
-                reader = csv.reader(infile)
-                next(reader)  # Skip header
-                for row in reader:
-                    writer.writerow(row)
+        for file_path in metadata_files[1:]:
+            with open(file_path, 'rb') as infile:
+                infile.readline()  # Skip header
+                shutil.copyfileobj(infile, outfile, length=1 << 20)
     
     print(f"Merged metadata saved to {merged_file}")
 
@@ -15,9 +15,30 @@ import json
 import argparse
 import sys
 import time
+import importlib
+import tempfile
+import traceback
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 from pathlib import Path
 import subprocess
 
+# Extensions counted as extracted neume images
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png'})
+
+def count_images(path):
+    """Count image files under path with one scandir per directory"""
+    count = 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                # DirEntry caches the file type, so this needs no extra stat
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                    count += 1
+    return count
+
 def setup_directories():
     """Setup necessary directories for the integration"""
     os.makedirs('../public/reference_images', exist_ok=True)
@@ -25,9 +46,81 @@ def setup_directories():
     os.makedirs('./logs', exist_ok=True)
     return True
 
-def run_process(command, log_file=None):
-    """Run a process and capture output"""
+@contextmanager
+def redirect_fds(out):
+    """
+    Point file descriptors 1 and 2 at the file out while the block runs, so
+    output written below sys.stdout/sys.stderr (process pool workers, C
+    extensions) lands in out as well
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    try:
+        os.dup2(out.fileno(), 1)
+        os.dup2(out.fileno(), 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip((1, 2), saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+def run_script(command, out):
+    """
+    Run a ['python', script, *args] command in this interpreter by importing
+    the script as a module and calling its main(), writing its output to the
+    file out. Importing by module name lets the scripts' process pools still
+    pickle their functions.
+    """
+    script, *script_args = command[1:]
+    if not os.path.isfile(script):
+        print(f"Script not found: {script}", file=out)
+        return False
+    
+    script_dir, script_file = os.path.split(os.path.abspath(script))
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    
+    saved_argv = sys.argv
+    sys.argv = [script, *script_args]
+    try:
+        # Redirect the file descriptors as well as sys.stdout/sys.stderr, so
+        # the scripts' pool workers write to the log and not to the JSON
+        # result on this process's stdout
+        with redirect_fds(out), redirect_stdout(out), redirect_stderr(out):
+            try:
+                module = importlib.import_module(os.path.splitext(script_file)[0])
+                return module.main() in (None, 0)
+            except SystemExit as e:
+                return e.code in (None, 0)
+            except Exception:
+                traceback.print_exc()
+                return False
+    finally:
+        sys.argv = saved_argv
+
+def run_process(command, log_file=None, isolate=False):
+    """
+    Run a process and capture output.
+    Python scripts run in this interpreter unless isolate is set, which
+    saves starting a second interpreter for the action; isolate runs them
+    in a subprocess so a crash can't take this process down with it.
+    """
     try:
+        if not isolate and command[0] == 'python':
+            if log_file:
+                with open(log_file, 'w') as f:
+                    return run_script(command, f)
+            else:
+                # Output is captured at the file descriptor level, so it
+                # needs a real file rather than a StringIO
+                with tempfile.TemporaryFile('w+') as out:
+                    success = run_script(command, out)
+                    out.seek(0)
+                    return success, out.read()
+        
         if log_file:
             with open(log_file, 'w') as f:
                 process = subprocess.Popen(
@@ -45,7 +138,7 @@ def run_process(command, log_file=None):
         print(f"Error running process: {e}")
         return False
 
-def generate_overlays(annotations_file, reference_dir='../public/reference_images'):
+def generate_overlays(annotations_file, reference_dir='../public/reference_images', isolate=False):
     """Generate overlay images for the neumes on reference images"""
     setup_directories()
     
@@ -58,7 +151,7 @@ def generate_overlays(annotations_file, reference_dir='../public/reference_image
     ]
     
     print(f"Generating overlay images from {annotations_file}...")
-    success = run_process(command, log_file)
+    success = run_process(command, log_file, isolate)
     
     return {
         'success': success,
@@ -66,7 +159,7 @@ def generate_overlays(annotations_file, reference_dir='../public/reference_image
         'log_file': log_file
     }
 
-def generate_reference_images(annotations_file):
+def generate_reference_images(annotations_file, isolate=False):
     """Generate reference images for the neumes"""
     setup_directories()
     
@@ -79,7 +172,7 @@ def generate_reference_images(annotations_file):
     ]
     
     print(f"Generating reference images from {annotations_file}...")
-    success = run_process(command, log_file)
+    success = run_process(command, log_file, isolate)
     
     return {
         'success': success,
@@ -87,7 +180,7 @@ def generate_reference_images(annotations_file):
         'log_file': log_file
     }
 
-def extract_neume_images(annotations_file, output_dir='./extracted_neumes'):
+def extract_neume_images(annotations_file, output_dir='./extracted_neumes', isolate=False):
     """Extract neume images from the annotations"""
     setup_directories()
     
@@ -100,7 +193,7 @@ def extract_neume_images(annotations_file, output_dir='./extracted_neumes'):
     ]
     
     print(f"Extracting neume images from {annotations_file}...")
-    success = run_process(command, log_file)
+    success = run_process(command, log_file, isolate)
     
     return {
         'success': success,
@@ -127,8 +220,7 @@ def get_status():
     total_images = 0
     for neume_dir in neume_dirs:
         if neume_dir.is_dir():
-            for root, _, files in os.walk(neume_dir):
-                total_images += sum(1 for f in files if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+            total_images += count_images(neume_dir)
     
     return {
         'reference_images': len(reference_images),
@@ -149,17 +241,19 @@ def main():
                        help='Output directory for extracted images')
     parser.add_argument('--reference-dir', default='../public/reference_images',
                        help='Directory containing reference images')
+    parser.add_argument('--isolate', action='store_true',
+                       help='Run each script in its own Python process instead of in-process')
     
     args = parser.parse_args()
     
     if args.action == 'reference':
-        result = generate_reference_images(args.annotations)
+        result = generate_reference_images(args.annotations, args.isolate)
         print(json.dumps(result, indent=2))
     elif args.action == 'overlay':
-        result = generate_overlays(args.annotations, args.reference_dir)
+        result = generate_overlays(args.annotations, args.reference_dir, args.isolate)
         print(json.dumps(result, indent=2))
     elif args.action == 'extract':
-        result = extract_neume_images(args.annotations, args.output)
+        result = extract_neume_images(args.annotations, args.output, args.isolate)
         print(json.dumps(result, indent=2))
     elif args.action == 'status':
         result = get_status()
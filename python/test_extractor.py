@@ -9,42 +9,44 @@ import argparse
 import requests
 from pathlib import Path
 from PIL import Image
-from io import BytesIO
-import time
+import re
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import sys
+from common import RateLimiter, create_session, save_stream
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Image base, region and size/rotation of an IIIF URL, e.g.
+# http://www.e-codices.unifr.ch/loris/csg/csg-0390/csg-0390_007.jp2/1425,1005,67,76/64,/0/default.jpg
+IIIF_URL_PATTERN = re.compile(
+    r'^(?P<base>.*?)/(?P<x>\d+),(?P<y>\d+),(?P<width>\d+),(?P<height>\d+)/[^/]+/\d+/default\.jpg$'
+)
+
+@lru_cache(maxsize=8192)
 def parse_iiif_url(url):
-    """Parse an IIIF URL into its components"""
-    try:
-        # Extract base URL and coordinates
-        base_url = url.replace('/[\d]+,[\d]+,[\d]+,[\d]+/64,/0/default.jpg', "")
-        dims_match = url.split('/')[-3].split(',')
-        
-        if len(dims_match) != 4:
-            print(f"Invalid IIIF URL format: {url}")
-            return None
-        
-        x, y, width, height = map(int, dims_match)
-        
-        # Extract page identifier
-        url_parts = url.split('/')
-        page_id = url_parts[6] if len(url_parts) > 6 else "unknown"
-        
-        return {
-            'base_url': base_url,
-            'x': x,
-            'y': y,
-            'width': width,
-            'height': height,
-            'page_id': page_id,
-            'full_url': url
-        }
-    except Exception as e:
-        print(f"Error parsing IIIF URL: {e}")
+    """Parse an IIIF URL into its components (cached; callers must not modify the result)"""
+    match = IIIF_URL_PATTERN.match(url)
+    if not match:
+        print(f"Invalid IIIF URL format: {url}")
         return None
+    
+    base_url = match.group('base')
+    return {
+        'base_url': base_url,
+        'x': int(match.group('x')),
+        'y': int(match.group('y')),
+        'width': int(match.group('width')),
+        'height': int(match.group('height')),
+        'page_id': base_url.rsplit('/', 1)[-1],
+        'full_url': url
+    }
 
-def download_image(iiif_info, output_dir, filename=None):
-    """Download and save a neume image"""
+def download_image(iiif_info, output_dir, filename=None, session=None, limiter=None):
+    """Download and save a neume image, through session and limiter if they are given"""
     if not iiif_info:
         return False
     
@@ -64,16 +66,25 @@ def download_image(iiif_info, output_dir, filename=None):
             return True
         
         # Download the image
+        if limiter is not None:
+            limiter.wait()
         print(f"Downloading image from {iiif_info['full_url']}")
-        response = requests.get(iiif_info['full_url'])
+        response = (session or requests).get(iiif_info['full_url'], stream=True, timeout=30)
         
         if response.status_code != 200:
             print(f"Failed to download image: {response.status_code}")
+            response.close()
             return False
         
-        # Save the image
-        img = Image.open(BytesIO(response.content))
-        img.save(output_path)
+        # Save the image; a JPEG body is written as-is rather than decoded
+        # and re-encoded, which also keeps the server's original quality
+        response.raw.decode_content = True
+        with response:
+            if response.headers.get('Content-Type', '').startswith('image/jpeg'):
+                save_stream(response.raw, output_path, 64 * 1024)
+            else:
+                # Some other format came back; convert it to JPEG
+                Image.open(response.raw).convert('RGB').save(output_path)
         print(f"Saved image to {output_path}")
         
         return True
@@ -81,12 +92,20 @@ def download_image(iiif_info, output_dir, filename=None):
         print(f"Error downloading image: {e}")
         return False
 
-def test_extraction(annotations_file, output_dir):
-    """Test extraction from annotations file"""
+def test_extraction(annotations_file, output_dir, workers=None, rate=4):
+    """
+    Test extraction from annotations file.
+    Images are downloaded on a pool of `workers` threads (default: up to 8)
+    sharing one keep-alive session, and streamed straight to disk. Request
+    starts are limited to `rate` per second across the pool (0: no limit).
+    """
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+    
     try:
         # Load annotations
-        with open(annotations_file, 'r') as f:
-            annotations = json.load(f)
+        with open(annotations_file, 'rb') as f:
+            annotations = orjson.loads(f.read()) if orjson is not None else json.load(f)
         
         print(f"Loaded {len(annotations)} annotation types")
         
@@ -97,35 +116,47 @@ def test_extraction(annotations_file, output_dir):
         # Track our progress
         total_images = sum(len(annot['urls']) for annot in annotations)
         processed_images = 0
-        successful_images = 0
-        
-        # Process each neume type
-        for annot in annotations:
-            neume_type = annot['type']
-            print(f"\nProcessing {neume_type} ({len(annot['urls'])} images)")
-            
-            # Create directory for this neume type
-            neume_dir = base_output_dir / neume_type.replace(' ', '_')
-            neume_dir.mkdir(exist_ok=True)
-            
-            # Process each URL
-            for i, url in enumerate(annot['urls']):
-                processed_images += 1
-                print(f"Image {processed_images}/{total_images}: {url}")
+        existing_images = 0
+        
+        # One request rate for the whole pool
+        limiter = RateLimiter(rate)
+        
+        # Process each neume type; the number of requests in flight is
+        # bounded by the pool size
+        with create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for annot in annotations:
+                neume_type = annot['type']
+                print(f"\nProcessing {neume_type} ({len(annot['urls'])} images)")
                 
-                # Parse the URL
-                iiif_info = parse_iiif_url(url)
-                if not iiif_info:
-                    continue
+                # Create directory for this neume type
+                neume_dir = base_output_dir / neume_type.replace(' ', '_')
+                neume_dir.mkdir(exist_ok=True)
+                neume_dir_path = str(neume_dir)
                 
-                # Download the image
-                filename = f"{iiif_info['page_id']}_{i:03d}.jpg"
-                success = download_image(iiif_info, str(neume_dir), filename)
-                if success:
-                    successful_images += 1
+                # One listing per type replaces an existence check per image
+                existing_names = set(os.listdir(neume_dir_path))
                 
-                # Add a small delay to avoid overwhelming the server
-                time.sleep(0.5)
+                # Process each URL
+                for i, url in enumerate(annot['urls']):
+                    processed_images += 1
+                    print(f"Image {processed_images}/{total_images}: {url}")
+                    
+                    # Parse the URL
+                    iiif_info = parse_iiif_url(url)
+                    if not iiif_info:
+                        continue
+                    
+                    # Download the image unless an earlier run already did
+                    filename = f"{iiif_info['page_id']}_{i:03d}.jpg"
+                    if filename in existing_names:
+                        print(f"Image already exists: {os.path.join(neume_dir_path, filename)}")
+                        existing_images += 1
+                        continue
+                    futures.append(executor.submit(download_image, iiif_info, neume_dir_path,
+                                                   filename, session, limiter))
+            
+            successful_images = existing_images + sum(1 for future in futures if future.result())
         
         # Print summary
         print(f"\nExtraction test complete!")
@@ -143,6 +174,10 @@ def main():
                        help='Path to annotations JSON file')
     parser.add_argument('--output', default='./extracted_test',
                        help='Output directory for extracted images')
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1),
+                       help='Number of parallel downloads (default: up to 8)')
+    parser.add_argument('--rate', type=float, default=4,
+                       help='Maximum requests per second to the image server (default: 4, 0 for no limit)')
     
     args = parser.parse_args()
     
@@ -150,7 +185,7 @@ def main():
     print(f"Annotations file: {args.annotations}")
     print(f"Output directory: {args.output}")
     
-    success = test_extraction(args.annotations, args.output)
+    success = test_extraction(args.annotations, args.output, args.workers, args.rate)
     
     if success:
         print("Test completed successfully")
@@ -11,18 +11,30 @@ import os
 import json
 import argparse
 import requests
-import time
 import sys
 from pathlib import Path
 from PIL import Image
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import re
+from functools import lru_cache
+from urllib.parse import urlsplit
+from common import RateLimiter, create_session, save_stream
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Region coordinates at the end of an annotation URL, e.g. /1425,1005,67,76/64,/0/default.jpg
+IIIF_COORDS_PATTERN = re.compile(r'(\d+),(\d+),(\d+),(\d+)/64,/0/default\.jpg$')
+
+@lru_cache(maxsize=8192)
 def parse_iiif_url(url):
-    """Parse an IIIF URL into its components for e-codices URLs"""
+    """Parse an IIIF URL into its components for e-codices URLs (cached; don't modify the result)"""
     try:
         # Extract coordinates using regex
-        coords_match = re.search(r'(\d+),(\d+),(\d+),(\d+)/64,/0/default.jpg', url)
+        coords_match = IIIF_COORDS_PATTERN.search(url)
         if not coords_match:
             print(f"Invalid IIIF URL format: {url}")
             return None
@@ -32,18 +44,20 @@ def parse_iiif_url(url):
         width = int(coords_match.group(3))
         height = int(coords_match.group(4))
         
-        # Extract manuscript and page information
-        url_parts = url.split('/')
-        if len(url_parts) < 7:
+        # Extract manuscript and page information from the path only; the
+        # regex above already fixed its last four segments, so the page and
+        # manuscript sit right before them
+        path_parts = urlsplit(url).path.split('/')
+        if len(path_parts) < 7:
             print(f"URL doesn't contain expected parts: {url}")
             return None
             
-        manuscript = url_parts[5]  # e.g., csg-0390
-        page = url_parts[6].split('.')[0]  # e.g., csg-0390_007
+        manuscript = path_parts[-6]  # e.g., csg-0390
+        page = path_parts[-5].partition('.')[0]  # e.g., csg-0390_007
         page_number = page.split('_')[1]  # e.g., 007
         
-        # Extract base URL
-        base_url = '/'.join(url_parts[:-1]).rsplit('/', 1)[0]
+        # Extract base URL (everything before the rotation segment)
+        base_url = url.rsplit('/', 2)[0]
         
         return {
             'x': x,
@@ -60,15 +74,25 @@ def parse_iiif_url(url):
         print(f"Error parsing IIIF URL: {e}")
         return None
 
-def download_neume_image(url, output_dir, filename=None):
-    """Download a neume image from an IIIF URL"""
-    iiif_info = parse_iiif_url(url)
+def download_neume_image(url, output_dir, filename=None, session=None, iiif_info=None,
+                         validate=False, limiter=None, skip_mkdir=False):
+    """
+    Download a neume image from an IIIF URL, through session if one is given.
+    Callers that have already parsed the URL pass its iiif_info along.
+    JPEG responses are written to disk as received unless validate is set,
+    in which case every image is decoded with Pillow before it is saved.
+    A shared limiter keeps all downloads under one request rate.
+    Callers that already created output_dir pass skip_mkdir.
+    """
+    if iiif_info is None:
+        iiif_info = parse_iiif_url(url)
     if not iiif_info:
         return False, None
     
     try:
         # Create output directory
-        os.makedirs(output_dir, exist_ok=True)
+        if not skip_mkdir:
+            os.makedirs(output_dir, exist_ok=True)
         
         # Generate filename if not provided
         if not filename:
@@ -81,16 +105,28 @@ def download_neume_image(url, output_dir, filename=None):
             return True, output_path
         
         # Download image
+        if limiter is not None:
+            limiter.wait()
         print(f"Downloading image from {url}")
-        response = requests.get(url)
+        response = (session or requests).get(url, stream=True, timeout=(3.05, 30))
         
         if response.status_code != 200:
             print(f"Failed to download image: {response.status_code}")
+            response.close()
             return False, None
         
-        # Save image
-        img = Image.open(BytesIO(response.content))
-        img.save(output_path)
+        # Save image; the server already sends the JPEG we want, so it is
+        # copied straight to disk instead of being decoded and re-encoded
+        with response:
+            if not validate and response.headers.get('Content-Type', '').startswith('image/jpeg'):
+                # Let urllib3 undo any Content-Encoding while copying, and copy
+                # in 1 MB chunks rather than copyfileobj's small default
+                response.raw.decode_content = True
+                save_stream(response.raw, output_path, 1 << 20)
+            else:
+                # Decode to check the image (or convert another format) first
+                img = Image.open(BytesIO(response.content))
+                img.convert('RGB').save(output_path)
         print(f"Saved image to {output_path}")
         
         return True, output_path
@@ -98,14 +134,29 @@ def download_neume_image(url, output_dir, filename=None):
         print(f"Error downloading image: {e}")
         return False, None
 
-def extract_real_neumes(annotations_file, output_dir):
-    """Extract real neume images from annotations file"""
+def iter_annotations(file_path):
+    """Yield the annotation entries one at a time, streaming them when ijson is installed"""
+    with open(file_path, 'rb') as f:
+        if ijson is not None:
+            # Only the neume type being processed is held in memory
+            yield from ijson.items(f, 'item')
+        else:
+            yield from json.load(f)
+
+def extract_real_neumes(annotations_file, output_dir, workers=None, validate=False, rate=4):
+    """
+    Extract real neume images from annotations file.
+    Downloads run on a pool of `workers` threads (default: up to 8) sharing
+    one keep-alive session. Request starts are limited to `rate` per second
+    (0: unlimited), and 429/503 answers are retried after the server's
+    Retry-After delay.
+    """
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+    
     try:
-        # Load annotations
-        with open(annotations_file, 'r') as f:
-            annotations = json.load(f)
-        
-        print(f"Loaded {len(annotations)} neume types")
+        # Load annotations lazily; types are counted as they are processed
+        annotations = iter_annotations(annotations_file)
         
         # Create base output directory
         base_dir = Path(output_dir)
@@ -120,78 +171,116 @@ def extract_real_neumes(annotations_file, output_dir):
             'neume_types': []
         }
         
-        # Process each neume type
-        for annotation in annotations:
-            neume_type = annotation['type']
-            num_urls = len(annotation['urls'])
-            print(f"\nProcessing {neume_type} ({num_urls} images)")
-            
-            # Add to statistics
-            stats['total_neumes'] += num_urls
-            stats['neume_types'].append({
-                'type': neume_type,
-                'count': num_urls,
-                'successful': 0
-            })
-            
-            # Create directory for this neume type
-            neume_dir = base_dir / neume_type.replace(' ', '_')
-            neume_dir.mkdir(exist_ok=True)
-            
-            # Process each URL
-            for i, url in enumerate(annotation['urls']):
-                print(f"Image {i+1}/{num_urls}: Processing...")
-                
-                # Parse URL to get manuscript and page info
-                iiif_info = parse_iiif_url(url)
-                if not iiif_info:
-                    continue
+        # One request rate for the whole pool
+        limiter = RateLimiter(rate)
+        
+        # One record per parsed URL: its type's stats entry, its IIIF info and
+        # its pending download (None when the image was already on disk);
+        # the statistics are computed from these in one pass at the end
+        records = []
+        # Names already in each page directory, listed once per directory so
+        # a resumed run doesn't stat every image it has already saved; a
+        # directory in here has also been created, so it is only made once
+        existing_by_dir = {}
+        
+        with create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+            # Process each neume type
+            for annotation in annotations:
+                neume_type = annotation['type']
+                num_urls = len(annotation['urls'])
+                print(f"\nProcessing {neume_type} ({num_urls} images)")
                 
                 # Add to statistics
-                stats['manuscripts'].add(iiif_info['manuscript'])
-                stats['pages'].add(iiif_info['page'])
-                
-                # Create directories for manuscript and page
-                manuscript_dir = neume_dir / iiif_info['manuscript']
-                manuscript_dir.mkdir(exist_ok=True)
-                
-                page_dir = manuscript_dir / iiif_info['page']
-                page_dir.mkdir(exist_ok=True)
+                stats['total_neumes'] += num_urls
+                type_stats = {
+                    'type': neume_type,
+                    'count': num_urls,
+                    'successful': 0
+                }
+                stats['neume_types'].append(type_stats)
                 
-                # Download image
-                filename = f"{i:03d}_{iiif_info['x']}_{iiif_info['y']}.jpg"
-                success, filepath = download_neume_image(url, str(page_dir), filename)
+                # Create directory for this neume type
+                neume_dir = base_dir / neume_type.replace(' ', '_')
+                neume_dir.mkdir(exist_ok=True)
                 
-                if success:
-                    stats['successful_downloads'] += 1
-                    for nt in stats['neume_types']:
-                        if nt['type'] == neume_type:
-                            nt['successful'] += 1
+                # Download outcome of each neume region seen for this type, so
+                # a URL repeated within the type shares the first download
+                outcomes = {}
                 
-                # Add a small delay to avoid overwhelming the server
-                time.sleep(0.5)
-        
-        # Generate report
-        report = f"# Neume Extraction Report\n\n"
-        report += f"## Summary\n\n"
-        report += f"- Total neume images: {stats['total_neumes']}\n"
-        report += f"- Successfully downloaded: {stats['successful_downloads']} ({stats['successful_downloads']/stats['total_neumes']*100:.1f}%)\n"
-        report += f"- Manuscripts: {len(stats['manuscripts'])}\n"
-        report += f"- Pages: {len(stats['pages'])}\n"
-        report += f"- Neume types: {len(stats['neume_types'])}\n\n"
-        
-        report += f"## Neume Types\n\n"
+                # Process each URL
+                for i, url in enumerate(annotation['urls']):
+                    print(f"Image {i+1}/{num_urls}: Processing...")
+                    
+                    # Parse URL to get manuscript and page info
+                    iiif_info = parse_iiif_url(url)
+                    if not iiif_info:
+                        continue
+                    
+                    region = (iiif_info['manuscript'], iiif_info['page'], iiif_info['x'],
+                              iiif_info['y'], iiif_info['width'], iiif_info['height'])
+                    if region in outcomes:
+                        print(f"Duplicate of an earlier {neume_type} image, skipping")
+                        records.append((type_stats, iiif_info, outcomes[region]))
+                        continue
+                    
+                    page_dir = neume_dir / iiif_info['manuscript'] / iiif_info['page']
+                    filename = f"{i:03d}_{iiif_info['x']}_{iiif_info['y']}.jpg"
+                    
+                    # The first URL for a page directory creates it (with its
+                    # manuscript directory) and lists what is already there
+                    existing = existing_by_dir.get(page_dir)
+                    if existing is None:
+                        page_dir.mkdir(parents=True, exist_ok=True)
+                        with os.scandir(page_dir) as entries:
+                            existing = existing_by_dir[page_dir] = {entry.name for entry in entries}
+                    
+                    # Skip images an earlier run already downloaded
+                    if filename in existing:
+                        outcomes[region] = None
+                        records.append((type_stats, iiif_info, None))
+                        continue
+                    
+                    # Queue the download; the limiter and pool size bound how
+                    # hard the server is hit, so there is no fixed delay per request
+                    future = executor.submit(download_neume_image, url, str(page_dir), filename,
+                                             session, iiif_info, validate, limiter,
+                                             skip_mkdir=True)
+                    outcomes[region] = future
+                    records.append((type_stats, iiif_info, future))
+            
+            print(f"\nQueued downloads for {len(stats['neume_types'])} neume types")
+            
+            # Tally the results once the downloads finish
+            for type_stats, iiif_info, future in records:
+                if future is None or future.result()[0]:
+                    type_stats['successful'] += 1
+        
+        stats['successful_downloads'] = sum(nt['successful'] for nt in stats['neume_types'])
+        stats['manuscripts'] = {iiif_info['manuscript'] for _, iiif_info, _ in records}
+        stats['pages'] = {iiif_info['page'] for _, iiif_info, _ in records}
+        
+        # Generate report; collect the lines and join them once rather than
+        # re-copying the growing string for every line
+        report_parts = [
+            f"# Neume Extraction Report\n\n",
+            f"## Summary\n\n",
+            f"- Total neume images: {stats['total_neumes']}\n",
+            f"- Successfully downloaded: {stats['successful_downloads']} ({stats['successful_downloads']/stats['total_neumes']*100:.1f}%)\n",
+            f"- Manuscripts: {len(stats['manuscripts'])}\n",
+            f"- Pages: {len(stats['pages'])}\n",
+            f"- Neume types: {len(stats['neume_types'])}\n\n",
+            f"## Neume Types\n\n"
+        ]
         for nt in stats['neume_types']:
-            report += f"- {nt['type']}: {nt['successful']}/{nt['count']} ({nt['successful']/nt['count']*100:.1f}%)\n"
+            report_parts.append(f"- {nt['type']}: {nt['successful']}/{nt['count']} ({nt['successful']/nt['count']*100:.1f}%)\n")
         
-        report += f"\n## Manuscripts\n\n"
+        report_parts.append(f"\n## Manuscripts\n\n")
         for ms in sorted(stats['manuscripts']):
-            report += f"- {ms}\n"
+            report_parts.append(f"- {ms}\n")
         
         # Save report
         report_path = base_dir / "extraction_report.md"
-        with open(report_path, 'w') as f:
-            f.write(report)
+        report_path.write_text("".join(report_parts))
         
         print(f"\nExtraction complete! Report saved to {report_path}")
         return True
@@ -205,6 +294,12 @@ def main():
                       help='Path to annotations JSON file')
     parser.add_argument('--output', default='./extracted_real_neumes',
                       help='Output directory for extracted images')
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1),
+                      help='Number of parallel downloads (default: up to 8)')
+    parser.add_argument('--validate', action='store_true',
+                      help='Decode every image with Pillow before saving it')
+    parser.add_argument('--rate', type=float, default=4,
+                      help='Maximum requests per second to the image server (default: 4, 0 for no limit)')
     
     args = parser.parse_args()
     
@@ -212,7 +307,8 @@ def main():
     print(f"Annotations file: {args.annotations}")
     print(f"Output directory: {args.output}")
     
-    success = extract_real_neumes(args.annotations, args.output)
+    success = extract_real_neumes(args.annotations, args.output, args.workers, args.validate,
+                                  args.rate)
     
     if success:
         print("\nExtraction completed successfully!")
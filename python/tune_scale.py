@@ -5,10 +5,83 @@ This script creates multiple overlays with different settings.
 """
 
 import os
-import subprocess
+import io
 import argparse
+from contextlib import redirect_stdout
 from pathlib import Path
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from overlay import enhanced_overlay
+from string import Template
+
+# Comparison page; $web_cards and $full_cards take the rendered cards below
+PAGE_TEMPLATE = Template("""<!DOCTYPE html>
+<html>
+<head>
+    <title>Scale Adjustment Comparison</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 20px; }
+        h1, h2 { color: #333; }
+        .image-grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(300px, 1fr)); gap: 20px; }
+        .adjustment-container { margin-bottom: 30px; border: 1px solid #ccc; padding: 20px; border-radius: 5px; }
+        .image-card { border: 1px solid #ddd; padding: 10px; border-radius: 5px; }
+        img { max-width: 100%; border: 1px solid #eee; }
+        .settings { background-color: #f5f5f5; padding: 10px; margin-bottom: 20px; border-radius: 5px; }
+        .success { color: green; }
+        .error { color: red; }
+    </style>
+</head>
+<body>
+    <h1>Scale Adjustment Comparison</h1>
+    <div class="settings">
+        <h3>Settings:</h3>
+        <ul>
+            <li><strong>Base Scale:</strong> $base_scale</li>
+            <li><strong>Line Width:</strong> $line_width</li>
+            <li><strong>Box Padding:</strong> $box_padding</li>
+            <li><strong>Corner Size:</strong> $corner_size</li>
+            <li><strong>Color:</strong> $color</li>
+        </ul>
+    </div>
+    
+    <h2>Web-Friendly Versions</h2>
+    <div class="image-grid">
+$web_cards
+    </div>
+    
+    <h2>Full-Size Versions</h2>
+    <div class="image-grid">
+$full_cards
+    </div>
+</body>
+</html>
+""")
+
+# One overlay image; $src is the web or the full-size file
+CARD_TEMPLATE = Template("""
+        <div class="image-card">
+            <h3>Adjustment: $adjustment</h3>
+            <p>$scale_info</p>
+            <img src="$src" alt="Adjustment $adjustment">
+            <p><a href="$src" target="_blank">View Full Size</a></p>
+        </div>
+""")
+
+# An adjustment whose overlay failed to render
+ERROR_CARD_TEMPLATE = Template("""
+        <div class="image-card">
+            <h3>Adjustment: $adjustment</h3>
+            <p class="error">Error: $error</p>
+        </div>
+""")
+
+def run_overlay(overlay_args):
+    """Render one overlay with enhanced_overlay, returning its exit code, output and duration"""
+    start_time = time.time()
+    output = io.StringIO()
+    with redirect_stdout(output):
+        exit_code = enhanced_overlay.main(overlay_args)
+    return exit_code, output.getvalue(), time.time() - start_time
 
 def main():
     parser = argparse.ArgumentParser(description='Scale and parameter tuner')
@@ -53,8 +126,10 @@ def main():
     # Base scale parameter
     scale_param = f"--scale {args.base_scale}" if args.base_scale is not None else ""
     
-    # Generate overlays with different scale adjustments
+    # Generate overlays with different scale adjustments; each one is
+    # independent, so render them side by side
     results = {}
+    jobs = {}
     
     for adjustment in adjustments:
         timestamp = int(time.time())
@@ -62,9 +137,7 @@ def main():
         output_path = os.path.join(args.output_dir, output_filename)
         web_output_path = output_path.replace('.jpg', '_web.jpg')
         
-        print(f"\nGenerating overlay with scale adjustment {adjustment:.2f}")
-        command = [
-            'python', 'enhanced_overlay.py',
+        overlay_args = [
             '--annotations', args.annotations,
             '--image', args.image,
             '--output', output_path,
@@ -78,121 +151,89 @@ def main():
         ]
         
         if args.base_scale is not None:
-            command.extend(['--scale', str(args.base_scale)])
+            overlay_args.extend(['--scale', str(args.base_scale)])
         
-        try:
-            start_time = time.time()
-            process = subprocess.run(command, check=True, capture_output=True, text=True)
-            end_time = time.time()
-            
-            # Extract scale factor from output
-            scale_line = None
-            for line in process.stdout.split('\n'):
-                if "Adjusted scale factor:" in line:
-                    scale_line = line
-                    break
-            
-            results[adjustment] = {
-                'output': output_filename,
-                'web_output': os.path.basename(web_output_path),
-                'time': end_time - start_time,
-                'scale_info': scale_line,
-                'success': True
-            }
-            
-            print(f"Generated {output_path}")
-            print(f"Web version: {web_output_path}")
-            print(f"Time taken: {end_time - start_time:.2f} seconds")
-            if scale_line:
-                print(scale_line)
+        jobs[adjustment] = (overlay_args, output_filename, output_path, web_output_path)
+    
+    # Rendering is CPU-bound, so use one worker process per core; each worker
+    # imports enhanced_overlay (and Pillow) once and then renders in-process
+    # instead of starting a fresh interpreter per adjustment
+    with ProcessPoolExecutor(max_workers=max(1, min(len(jobs), os.cpu_count() or 1))) as executor:
+        futures = {}
+        for adjustment, (overlay_args, *_) in jobs.items():
+            print(f"\nGenerating overlay with scale adjustment {adjustment:.2f}")
+            futures[executor.submit(run_overlay, overlay_args)] = adjustment
+        
+        for future in as_completed(futures):
+            adjustment = futures[future]
+            _, output_filename, output_path, web_output_path = jobs[adjustment]
             
-        except Exception as e:
-            print(f"Error generating overlay with adjustment {adjustment}: {e}")
-            results[adjustment] = {
-                'success': False,
-                'error': str(e)
-            }
+            try:
+                exit_code, stdout, elapsed = future.result()
+                if exit_code:
+                    raise RuntimeError(f"enhanced_overlay exited with status {exit_code}")
+                
+                # Extract scale factor from output
+                scale_line = None
+                for line in stdout.split('\n'):
+                    if "Adjusted scale factor:" in line:
+                        scale_line = line
+                        break
+                
+                results[adjustment] = {
+                    'output': output_filename,
+                    'web_output': os.path.basename(web_output_path),
+                    'time': elapsed,
+                    'scale_info': scale_line,
+                    'success': True
+                }
+                
+                print(f"\nGenerated {output_path} (adjustment {adjustment:.2f})")
+                print(f"Web version: {web_output_path}")
+                print(f"Time taken: {elapsed:.2f} seconds")
+                if scale_line:
+                    print(scale_line)
+                
+            except Exception as e:
+                print(f"Error generating overlay with adjustment {adjustment}: {e}")
+                results[adjustment] = {
+                    'success': False,
+                    'error': str(e)
+                }
     
     # Create an HTML file to view all the overlays
     html_path = os.path.join(args.output_dir, "adjustment_comparison.html")
     
-    with open(html_path, 'w') as f:
-        f.write(f"""<!DOCTYPE html>
-<html>
-<head>
-    <title>Scale Adjustment Comparison</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 20px; }}
-        h1, h2 {{ color: #333; }}
-        .image-grid {{ display: grid; grid-template-columns: repeat(auto-fill, minmax(300px, 1fr)); gap: 20px; }}
-        .adjustment-container {{ margin-bottom: 30px; border: 1px solid #ccc; padding: 20px; border-radius: 5px; }}
-        .image-card {{ border: 1px solid #ddd; padding: 10px; border-radius: 5px; }}
-        img {{ max-width: 100%; border: 1px solid #eee; }}
-        .settings {{ background-color: #f5f5f5; padding: 10px; margin-bottom: 20px; border-radius: 5px; }}
-        .success {{ color: green; }}
-        .error {{ color: red; }}
-    </style>
-</head>
-<body>
-    <h1>Scale Adjustment Comparison</h1>
-    <div class="settings">
-        <h3>Settings:</h3>
-        <ul>
-            <li><strong>Base Scale:</strong> {args.base_scale if args.base_scale is not None else "Auto"}</li>
-            <li><strong>Line Width:</strong> {args.line_width}</li>
-            <li><strong>Box Padding:</strong> {args.box_padding}</li>
-            <li><strong>Corner Size:</strong> {args.corner_size}</li>
-            <li><strong>Color:</strong> {args.color}</li>
-        </ul>
-    </div>
-    
-    <h2>Web-Friendly Versions</h2>
-    <div class="image-grid">
-""")
-        
-        # Add web-friendly versions first
-        for adjustment, result in sorted(results.items()):
-            if result['success']:
-                f.write(f"""
-        <div class="image-card">
-            <h3>Adjustment: {adjustment:.2f}</h3>
-            <p>{result.get('scale_info', '')}</p>
-            <img src="{result['web_output']}" alt="Adjustment {adjustment:.2f}">
-            <p><a href="{result['web_output']}" target="_blank">View Full Size</a></p>
-        </div>
-""")
-        
-        f.write("""
-    </div>
+    # Render every card, then the page, and write it in one call
+    web_cards = []
+    full_cards = []
+    for adjustment, result in sorted(results.items()):
+        if result['success']:
+            web_cards.append(CARD_TEMPLATE.substitute(
+                adjustment=f"{adjustment:.2f}",
+                scale_info=result.get('scale_info', ''),
+                src=result['web_output']
+            ))
+            full_cards.append(CARD_TEMPLATE.substitute(
+                adjustment=f"{adjustment:.2f}",
+                scale_info=result.get('scale_info', ''),
+                src=result['output']
+            ))
+        else:
+            full_cards.append(ERROR_CARD_TEMPLATE.substitute(
+                adjustment=f"{adjustment:.2f}",
+                error=result.get('error', 'Unknown error')
+            ))
     
-    <h2>Full-Size Versions</h2>
-    <div class="image-grid">
-""")
-        
-        # Add full-size versions
-        for adjustment, result in sorted(results.items()):
-            if result['success']:
-                f.write(f"""
-        <div class="image-card">
-            <h3>Adjustment: {adjustment:.2f}</h3>
-            <p>{result.get('scale_info', '')}</p>
-            <img src="{result['output']}" alt="Adjustment {adjustment:.2f}">
-            <p><a href="{result['output']}" target="_blank">View Full Size</a></p>
-        </div>
-""")
-            else:
-                f.write(f"""
-        <div class="image-card">
-            <h3>Adjustment: {adjustment:.2f}</h3>
-            <p class="error">Error: {result.get('error', 'Unknown error')}</p>
-        </div>
-""")
-        
-        f.write("""
-    </div>
-</body>
-</html>
-""")
+    Path(html_path).write_text(PAGE_TEMPLATE.substitute(
+        base_scale=args.base_scale if args.base_scale is not None else "Auto",
+        line_width=args.line_width,
+        box_padding=args.box_padding,
+        corner_size=args.corner_size,
+        color=args.color,
+        web_cards="".join(web_cards),
+        full_cards="".join(full_cards)
+    ))
     
     print(f"\nCreated comparison HTML file: {html_path}")
     print(f"Open this file in your browser to compare different scale adjustments")